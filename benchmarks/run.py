@@ -0,0 +1,221 @@
+#!/usr/bin/env python
+'''
+Benchmarks of the muto decoders and HDF5 storage, run on synthetic data.
+
+Times decode throughput of the CL31 (each height code) and CT12 readers,
+log file reading, append throughput and slice latency by window length.
+Each benchmark runs in its own process, so the peak memory reported is its
+own. Results are printed, and written as JSON with -o, so that they can be
+compared with an earlier run:
+
+    python benchmarks/run.py -o new.json --compare old.json
+
+Use --quick for a short run, and -k to only run benchmarks whose name
+contains the given text.
+'''
+import os
+import sys
+import json
+import time
+import shutil
+import platform
+import argparse
+import resource
+import tempfile
+import multiprocessing
+import numpy as np
+# run from the source tree without installing
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import muto
+import tables
+import logging as l
+from muto.accessories.decoders.profile import vaisala_cl31, vaisala_ct12, logfile
+from muto.storage.h5 import h5
+import synthetic
+
+# slice window lengths, in seconds
+WINDOWS = (600, 3600, 86400, 7 * 86400)
+
+
+def best(func, repeat):
+    '''
+    The fastest of repeated runs of func, in seconds
+    '''
+    times = []
+    for i in range(repeat):
+        stime = time.time()
+        func()
+        times.append(time.time() - stime)
+    return min(times)
+
+
+def decode(directory, instrument, code, n, repeat, batch):
+    obs = synthetic.messages(instrument, n, code)
+    if instrument == 'cl31' and batch:
+        func = lambda: vaisala_cl31.read_batch(obs)
+    elif instrument == 'cl31':
+        func = lambda: [vaisala_cl31.read(ob) for ob in obs]
+    else:
+        # the ct12 reader takes the text between STX and ETX
+        obs = [ob[1:-1] for ob in obs]
+        if batch:
+            func = lambda: vaisala_ct12.read_batch(obs)
+        else:
+            func = lambda: [vaisala_ct12.read(ob) for ob in obs]
+    return {'value':n / best(func, repeat), 'unit':'obs/s'}
+
+
+def log(directory, instrument, n, repeat):
+    fname = os.path.join(directory, instrument + '.log')
+    size = synthetic.log_file(fname, instrument, n)
+    def func():
+        for times, out in logfile.iter_log(fname, instrument):
+            pass
+    seconds = best(func, repeat)
+    return {'value':n / seconds, 'unit':'obs/s',
+            'mb_per_s':size / seconds / 2 ** 20}
+
+
+def append(directory, method, batch, n, repeat):
+    bs = np.random.RandomState(0).normal(-6, 1, (batch, 770))
+    def func():
+        fname = os.path.join(directory, 'append.h5')
+        if os.path.exists(fname):
+            os.remove(fname)
+        archive = h5(fname)
+        archive.create(bs=(770,), status=(13,))
+        for first in range(0, n, batch):
+            times = synthetic.START + 16 * np.arange(first, first + batch)
+            if method == 'append':
+                for k in range(batch):
+                    archive.append(times[k], persist=True, bs=bs[k])
+            else:
+                archive.append_many(times, persist=True, bs=bs)
+        archive.close()
+    return {'value':n / best(func, repeat), 'unit':'rows/s'}
+
+
+def slices(directory, days, repeat, cache):
+    fname = os.path.join(directory, 'slice.h5')
+    archive = h5(fname, cache=cache)
+    archive.create(bs=(770,), status=(13,), levels=True)
+    times = synthetic.START + 16 * np.arange(days * 5400)
+    bs = np.random.RandomState(0).normal(-6, 1, (5400, 770))
+    for day in range(days):
+        archive.append_many(times[day * 5400:(day + 1) * 5400], persist=True,
+                            bs=bs)
+    archive.close()
+    out = {}
+    for window in WINDOWS:
+        if window > days * 86400:
+            continue
+        begin = synthetic.START + days * 43200 - window // 2
+        func = lambda: archive.slice(['bs', 'status'],
+                                     timetup=(begin, begin + window))
+        out[str(window)] = best(func, repeat) * 1000
+        out[str(window) + '_coarse'] = best(
+            lambda: archive.slice(['bs'], timetup=(begin, begin + window),
+                                  max_points=1000), repeat) * 1000
+    return {'value':out, 'unit':'ms'}
+
+
+def benchmarks(quick):
+    '''
+    The names, functions and arguments of all of the benchmarks
+    '''
+    n, repeat, days = (400, 2, 2) if quick else (4000, 5, 14)
+    out = []
+    for code in sorted(synthetic.CL31_CODES):
+        out.append(('decode_cl31_code%d' % code, decode,
+                    ('cl31', code, n, repeat, False)))
+        out.append(('decode_cl31_batch_code%d' % code, decode,
+                    ('cl31', code, n, repeat, True)))
+    out.append(('decode_ct12', decode, ('ct12', None, n, repeat, False)))
+    out.append(('decode_ct12_batch', decode, ('ct12', None, n, repeat, True)))
+    out.append(('log_cl31', log, ('cl31', n, repeat)))
+    out.append(('log_ct12', log, ('ct12', n, repeat)))
+    out.append(('append_row', append, ('append', 100, n, repeat)))
+    for batch in (100, 1000):
+        out.append(('append_many_%d' % batch, append,
+                    ('append_many', batch, n * 10, repeat)))
+    out.append(('slice', slices, (days, repeat, False)))
+    out.append(('slice_cached', slices, (days, repeat, True)))
+    return out
+
+
+def _run(job):
+    '''
+    Run one benchmark in a temporary directory, and add the peak memory of
+    the process
+    '''
+    name, func, args = job
+    l.getLogger().setLevel(l.WARNING)
+    directory = tempfile.mkdtemp(prefix='muto-bench-')
+    try:
+        out = func(directory, *args)
+    finally:
+        shutil.rmtree(directory)
+    # ru_maxrss is in kilobytes on linux
+    out['peak_mb'] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.
+    out['name'] = name
+    return out
+
+
+def compare(results, fname):
+    '''
+    Print the ratio of each result to the same result of an earlier run
+    '''
+    old = dict([(r['name'], r) for r in json.load(open(fname))['results']])
+    for r in results:
+        if r['name'] not in old:
+            continue
+        values, before = r['value'], old[r['name']]['value']
+        if not isinstance(values, dict):
+            values, before = {'':values}, {'':before}
+        for k in sorted(values):
+            if k in before and before[k]:
+                print '%-28s %-12s %12.4g %12.4g %8.2fx' % (
+                    r['name'], k, before[k], values[k], values[k] / before[k])
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='run the muto benchmarks')
+    parser.add_argument('-o', '--output',
+                        help='the JSON file results are written to, by '
+                        + 'default they are only printed')
+    parser.add_argument('-q', '--quick', action='store_true',
+                        help='use less data and fewer repeats')
+    parser.add_argument('-k', '--keyword', default='',
+                        help='only run benchmarks with this in their name')
+    parser.add_argument('--compare', help='an earlier results file')
+    args = parser.parse_args(argv)
+
+    results = []
+    for job in benchmarks(args.quick):
+        if args.keyword not in job[0]:
+            continue
+        # a fresh process per benchmark, so peak memory is its own
+        pool = multiprocessing.Pool(1)
+        try:
+            out = pool.apply(_run, (job,))
+        finally:
+            pool.terminate()
+        print '%-28s %s %s (peak %.0f MB)' % (out['name'], out['value'],
+                                               out['unit'], out['peak_mb'])
+        results.append(out)
+    doc = {'date':time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime()),
+           'quick':args.quick,
+           'muto':muto.version(),
+           'python':platform.python_version(),
+           'numpy':np.__version__,
+           'tables':tables.__version__,
+           'platform':platform.platform(),
+           'results':results}
+    if args.output:
+        json.dump(doc, open(args.output, 'w'), indent=1, sort_keys=True)
+    if args.compare:
+        compare(results, args.compare)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,110 @@
+'''
+Generators of synthetic, but realistically shaped, ceilometer messages and
+log files for the benchmarks.
+
+Profiles are a decaying aerosol layer with a cloud somewhere above it and a
+little noise, so the hex strings have the mix of small, large and negative
+values that the decoders see in real data. Everything is seeded, so the same
+arguments always give the same messages.
+'''
+import time
+import numpy as np
+
+# the data lengths and gate spacings (m) of the CL31 height codes 1-4
+CL31_CODES = {1:(770, 10), 2:(385, 20), 3:(1500, 5), 4:(770, 5)}
+# ct12 data lines hold 20 values each, the 13th only the last 10 of 250
+CT12_LINES = 13
+# the timestamp format written after each message, as in the ct12tocsv script
+TIMESTAMP_FORMAT = "%m/%d/%Y %H:%M:%S"
+# the start of the synthetic logs, 2013-02-09 20:53:26
+START = 1360443206
+
+
+def profile(rs, length, spacing, scale=1.):
+    '''
+    A synthetic backscatter profile of integers, in the 1e-9 sr^-1 m^-1 units
+    of the CL31 data message
+
+    Parameters
+    ----------
+    rs: numpy.random.RandomState
+    length: int
+        the number of gates
+    spacing: float
+        the gate spacing in meters
+    scale: float
+        a factor applied to the whole profile
+    '''
+    height = np.arange(length) * spacing
+    aerosol = rs.uniform(200, 2000) * np.exp(-height / rs.uniform(500, 2000))
+    out = aerosol + rs.normal(0, 20, length)
+    if rs.rand() < .6:
+        # and a cloud
+        base = rs.uniform(300, height[-1])
+        out += rs.uniform(1e4, 2e5) * np.exp(-((height - base) / 60.) ** 2)
+    return (out * scale).astype(int)
+
+
+def cl31_message(rs, code=1):
+    '''
+    A complete CL31 message 2, from the SOH to the EOT character, with the
+    height code given (1-4)
+    '''
+    length, spacing = CL31_CODES[code]
+    values = profile(rs, length, spacing)
+    # 20 bit two's complement, so the noise makes negative values
+    prof = ''.join(['%05x' % (v & 0xFFFFF) for v in values])
+    sl1 = '%d0 %05d ///// ///// 00100000' % (rs.randint(0, 4),
+                                            rs.randint(100, 10000))
+    sl2 = '00100 10 %04d 098 +34 058 12 621 LF0106 081 ##' % length
+    return '\x01CL01023%d\x02\r\n%s\r\n%s\r\n%s\r\n\x03%04x\x04' % (
+        code, sl1, sl2, prof, rs.randint(0, 0xFFFF))
+
+
+def ct12_message(rs):
+    '''
+    A complete CT12 message, from the STX to the ETX character
+    '''
+    # ct12 values are 2 hex digits of 50 * ln(bs), with 250 15 m gates
+    values = profile(rs, 250, 15) + 1000
+    values = np.clip(50 * np.log(np.clip(values, 1, None) / 1000.) + 1, 0, 255)
+    values = values.astype(int)
+    cl = '%d   %05d ///// ///// ///// 00000100010' % (rs.randint(0, 4),
+                                                    rs.randint(10, 3750))
+    il = '2 2 0100 123 045 067 0089 12345 12 34'
+    lines = [cl, il]
+    for k in range(CT12_LINES):
+        pairs = ''.join(['%02x' % v for v in values[k * 20:k * 20 + 20]])
+        lines.append('%02d' % k + pairs)
+    return '\x02' + '\r\n'.join(lines) + '\r\n\x03'
+
+
+def messages(instrument='cl31', n=1000, code=None, seed=0):
+    '''
+    A list of n messages, for the cl31 the height code cycles through 1-4
+    unless one is given
+    '''
+    rs = np.random.RandomState(seed)
+    if instrument == 'ct12':
+        return [ct12_message(rs) for i in range(n)]
+    return [cl31_message(rs, code or 1 + i % 4) for i in range(n)]
+
+
+def log_file(fname, instrument='cl31', n=1000, code=None, seed=0, step=16,
+             start=START):
+    '''
+    Write a log file of n messages, each followed by a timestamp line, as
+    written by the logging computers, and return its size in bytes
+    '''
+    rs = np.random.RandomState(seed)
+    f = open(fname, 'wb')
+    for i in range(n):
+        if instrument == 'ct12':
+            ob = ct12_message(rs)
+        else:
+            ob = cl31_message(rs, code or 1 + i % 4)
+        stamp = time.strftime(TIMESTAMP_FORMAT, time.gmtime(start + i * step))
+        f.write(ob + '\r\n' + stamp + '.058\r\n')
+    size = f.tell()
+    f.close()
+    return size
@@ -1,4 +1,4 @@
-all = ['vaisala_ct12','vaisala_cl31']
+all = ['vaisala_ct12','vaisala_cl31','logfile']
 '''
 Methods to decode observations made by instruments which create vertical
 profiles of the atmosphere. With this information, it is expected that 
@@ -22,7 +22,8 @@ code will produce files which are slightly offset in time.
 
 # 1. Set some important parameters
 
-# specify how many bytes to read at a single time (larger values use more memory)
+# specify how many bytes to read at a single time (no longer used, the log file
+#    is memory mapped instead)
 READ_CHUNK = 100000
 # Should an informative header be inserted into the output CSV file?'
 PRINT_HEADER = True
@@ -48,8 +49,15 @@ import numpy as np
 import sys
 import calendar
 import time
+import mmap
 # for outputs we are going to use the standard logging library.
 l.basicConfig(level=l.DEBUG, format='%(asctime)s %(levelname)s %(message)s')
+# translation table from ascii character codes to hexadecimal digit values,
+# anything which is not a hexadecimal digit is marked with -1
+HEX_DIGITS = np.zeros(256, dtype=int) - 1
+for i, c in enumerate('0123456789abcdef'):
+    HEX_DIGITS[ord(c)] = HEX_DIGITS[ord(c.upper())] = i
+del i, c
 
 #### YOU SHOULD NOT NEED TO MAKE FURTHER MODIFICATIONS FOR BASIC OPERATION ####
 
@@ -90,21 +98,23 @@ def read(ob):
     values = np.zeros((250), dtype=np.float32)
     'Convert the 15 lines of data into one line, and replace spaces with 0s so the splitting works better'
     string = ob[len(dl[0]) + len(dl[1]) + 2:].replace(' ', '0').replace("\n", "").replace("\r", "").strip()
-    'create an index to keep track of which bin we are in'
-    index = 0
     '''
-    Loop through this backscatter string jumping every two characters. 
+    Gather every two character pair of this backscatter string at once.
     Noting that every 42nd character is a height index, and therefore should be skipped.
-    
+
     First, simply the DD value is saved, for computational efficiency. Once the profile is read
     the power is computed from the list of values in a more efficient manner (showing the power of numpy).
     '''
-    for i in xrange(2, len(string[2:]) + 1, 2):
-        if i % 42 == 0: continue
-        'Translate the hexidecimal string to an integer using the hex int function int(x,16)'
-        val = int(string[i:i + 2], 16)
-        values[index] = val
-        index += 1
+    if isinstance(string, unicode):
+        string = string.encode('ascii')
+    index = np.arange(2, len(string) - 1, 2)
+    index = index[index % 42 != 0]
+    'Translate the hexidecimal pairs to integers through the HEX_DIGITS lookup table'
+    digits = HEX_DIGITS[np.frombuffer(string, dtype=np.uint8)]
+    high, low = digits[index], digits[index + 1]
+    if (high < 0).any() or (low < 0).any():
+        raise ValueError('invalid hexadecimal character in ob')
+    values[:index.shape[0]] = high * 16 + low
     'derive the gain value from the status lines before, and the manual, gain = 0 or 2, so let it pick as the index'
     gain = [250., 0, 930.][int(status[-10])]
     'now use the formula to make a vector calculation for power over the entire length'
@@ -150,22 +160,55 @@ def create_csv_headers(bshandle, sthandle):
     sthandle.write(sth + '\n')
 
 
+def scan_frames(mm, start=chr(2), end=chr(3)):
+    '''
+    Find the offsets of every observation in a memory mapped log file,
+    without copying any of the file. Yields (begin, end) pairs, which are
+    the offsets of the start (STX) and end (ETX) control characters.
+
+    If an observation lost its end character, the next start character is
+    found before the end, and the broken observation is skipped.
+    '''
+    pos = 0
+    while True:
+        b = mm.find(start, pos)
+        if b < 0:
+            return
+        e = mm.find(end, b)
+        if e < 0:
+            return
+        yield mm.rfind(start, b, e), e
+        pos = e + 1
+
+
 def read_file(source, READ_CHUNK, PRINT_HEADER, TIMESTAMP_FORMAT,
               TIMEZONE_STRING, TIMESTAMP_AFTER):
     '''
     Read a single CT12 log file, with timestamps formatted in the defined way
     and create two CSV documents from that using the reader if possible. 
     
-    All 5 inputs are required for this function. 
-    
+    All 5 inputs are required for this function. The file is memory mapped
+    and scanned as a whole, so no observation is lost at a chunk boundary,
+    READ_CHUNK is only kept so existing calls still work.
+
+    Returns a dict of the number of observations 'found', 'decoded' and
+    'rejected'.
     '''
     try:
-        from muto.accessories.decoders.profile.vaisala_ct12 import read
-    except:
+        from muto.accessories.decoders.profile.vaisala_ct12 import read as reader
+    except ImportError:
         l.warning('The Muto package is not installed/accessible'\
                   + ' using self-contained version instead')
-    # open the file for reading.
-    readhandle = open(source, 'r')
+        reader = read
+    counts = {'found':0, 'decoded':0, 'rejected':0}
+    # open the file for reading, and map it into memory.
+    readhandle = open(source, 'rb')
+    try:
+        mm = mmap.mmap(readhandle.fileno(), 0, access=mmap.ACCESS_READ)
+    except ValueError:
+        # an empty file cannot be mapped
+        readhandle.close()
+        return counts
     # open the two output files for writing, meaning we OVERWRITE AND CLEAR these files.'
     bshandle = open(source + '.backscatter.csv', 'w')
     sthandle = open(source + '.status.csv', 'w')
@@ -173,66 +216,58 @@ def read_file(source, READ_CHUNK, PRINT_HEADER, TIMESTAMP_FORMAT,
     if PRINT_HEADER:
         # backscatter hedaer is simply time and then heights in meters'
         create_csv_headers(bshandle, sthandle)
-    # define variables for control structures, these are non printing unichar characters'
-    B = unichr(002)
-    C = unichr(003)
-    # begin a controlled infinite loop to read the file in chunks, the lazy way'
-    if TIMESTAMP_AFTER:
-        split_1 = B
-        split_2 = C
-        text_key = 0
-        time_key = -1
-    else:
-        split_1 = C
-        split_2 = B
-        text_key = -1
-        time_key = 0
 
-    while True:
-        # read a single chunk
-        data = readhandle.read(READ_CHUNK)
-        # if that returned nothing, we are done reading.
-        if not data:
-            break
-        # break out individual obs by splitting the file by the first ob.
-        data = data.split(split_1)
-        for ob in data:
-            # grab the time by splitting by the second control, taking the end value, and stripping whitespace'
-            tmstring = ob.split(split_2)[time_key].strip()
-            # CREAGER CORRECTION: in case there is a new line in this string, take the first line
-            if "\n" in tmstring:
-                tmstring = tmstring.split('/n')[0]
-            # now translate the time, and wrap in a try statement, to catch bad times = bad obs'
-            try:
-                tm = s2t(tmstring + TIMEZONE_STRING, TIMESTAMP_FORMAT)
-            except:
-                # 'the time was not in the right format
-                l.warning('I could not read this timestamp!: ' + str(sys.exc_info()))
-                continue
-            # 'now grab just the observation text'
-            try:
-                out = read(ob.split(split_2)[text_key].strip())
-            except:
-                # 'again, failed to read, = bad ob'
-                l.warning('ob read failed. (occassional failure ok, frequent '\
-                          + ' failure bad)')
-                continue
-            if not out:
-                continue
-            'if we made it to this point, the ob has been read successfully! So, now just save it'
-            l.debug('ob: ' + time.ctime(tm) + ' (success)')
-
-            'Now we will write this to the file, using join and map to convert values to strings'
-            bs = ','.join(map(str, out['bs']))
-            st = ','.join(map(str, out['status']))
-
-            bshandle.write(str(tm) + ',' + bs + '\n')
-            sthandle.write(str(tm) + ',' + st + '\n')
+    # the list of frame offsets is small, even for very large files
+    frames = list(scan_frames(mm))
+    counts['found'] = len(frames)
+    for k, (b, e) in enumerate(frames):
+        # the timestamp is the text between this ob and the next (or last) one
+        if TIMESTAMP_AFTER:
+            stop = frames[k + 1][0] if k + 1 < len(frames) else len(mm)
+            lines = mm[e + 1:stop].strip().splitlines()
+            tmstring = lines[0] if lines else ''
+        else:
+            begin = frames[k - 1][1] + 1 if k > 0 else 0
+            lines = mm[begin:b].strip().splitlines()
+            tmstring = lines[-1] if lines else ''
+        # now translate the time, and wrap in a try statement, to catch bad times = bad obs'
+        try:
+            tm = s2t(tmstring.strip() + TIMEZONE_STRING, TIMESTAMP_FORMAT)
+        except:
+            # 'the time was not in the right format
+            l.warning('I could not read this timestamp!: ' + str(sys.exc_info()))
+            counts['rejected'] += 1
+            continue
+        # 'now grab just the observation text'
+        try:
+            out = reader(mm[b + 1:e].strip())
+        except:
+            # 'again, failed to read, = bad ob'
+            l.warning('ob read failed. (occassional failure ok, frequent '\
+                      + ' failure bad)')
+            out = False
+        if not out:
+            counts['rejected'] += 1
+            continue
+        'if we made it to this point, the ob has been read successfully! So, now just save it'
+        l.debug('ob: ' + time.ctime(tm) + ' (success)')
+        counts['decoded'] += 1
+
+        'Now we will write this to the file, using join and map to convert values to strings'
+        bs = ','.join(map(str, out['bs']))
+        st = ','.join(map(str, out['status']))
+
+        bshandle.write(str(tm) + ',' + bs + '\n')
+        sthandle.write(str(tm) + ',' + st + '\n')
 
     'and close everything'
+    mm.close()
     readhandle.close()
     bshandle.close()
     sthandle.close()
+    l.info('obs found: %(found)d, decoded: %(decoded)d, rejected: %(rejected)d'
+           % counts)
+    return counts
 
 
 '3. Now that the functions exist, all we have to do is read the file, find the obs, and save them'
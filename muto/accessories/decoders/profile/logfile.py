@@ -0,0 +1,161 @@
+'''
+Read ceilometer log files, where each message from the instrument is
+framed by control characters and is preceded or followed by a timestamp
+line written by the logging computer.
+
+Files are read in chunks, so arbitrarily large logs can be processed with
+bounded memory, and the messages are decoded in batches by the batch readers
+of the instrument modules.
+'''
+import numpy as np
+import logging as l
+from muto.accessories import s2t
+from muto.accessories.decoders.profile import vaisala_cl31, vaisala_ct12
+
+# specify how many bytes to read at a single time (larger values use more memory)
+READ_CHUNK = 100000
+# messages longer than this are assumed to have lost their end character
+MAX_MESSAGE = 20000
+# default timestamp information, as in the ct12tocsv script
+TIMESTAMP_FORMAT = "%m/%d/%Y %H:%M:%S.%f%Z"
+TIMEZONE_STRING = "UTC"
+
+# framing characters and batch reader of each supported instrument. A CL31
+# message keeps its header and checksum, so it is framed by SOH/EOT, the
+# CT12 reader only wants the text between STX and ETX.
+INSTRUMENTS = {
+    'cl31': ('\x01', '\x04', vaisala_cl31.read_batch),
+    'ct12': ('\x02', '\x03', vaisala_ct12.read_batch),
+    }
+# the arrays of the batch readers with one entry per message
+PER_MESSAGE = ('bs', 'status', 'resolution')
+
+
+def iter_log(source, instrument='cl31', batch=500, chunk=READ_CHUNK,
+             time_format=TIMESTAMP_FORMAT, timezone=TIMEZONE_STRING,
+             timestamp_after=True, counts=None):
+    '''
+    Generator which reads a log file and yields the decoded observations in
+    batches of times and profiles.
+
+    Parameters
+    ----------
+    source: str or file
+        the log file name, or an open file object
+    instrument: str, optional
+        the message type, 'cl31' or 'ct12'
+    batch: int, optional
+        the number of messages decoded and yielded together
+    chunk: int, optional
+        the number of bytes read from the file at one time. Messages which
+        straddle two chunks are carried over to the next read.
+    time_format: str, optional
+        time.strptime format of the timestamp, TIMEZONE is appended to the
+        timestamp before it is read
+    timezone: str, optional
+        timezone string appended to every timestamp
+    timestamp_after: bool, optional
+        False if the timestamp occurs *BEFORE* the message it refers to
+    counts: dict, optional
+        if given, the 'found', 'decoded' and 'rejected' message counts are
+        accumulated in this dict
+
+    Yields
+    ------
+    times, out: numpy int array, dict
+        the epoch times of the successfully decoded messages, and the output
+        of the instrument batch reader reduced to those messages.
+    '''
+    start, end, reader = INSTRUMENTS[instrument]
+    if counts is None:
+        counts = {}
+    for k in ('found', 'decoded', 'rejected'):
+        counts.setdefault(k, 0)
+
+    times = []
+    obs = []
+    for stamp, ob in _frames(source, start, end, chunk, timestamp_after):
+        counts['found'] += 1
+        try:
+            times.append(s2t(stamp + timezone, time_format))
+        except ValueError:
+            l.warning('I could not read this timestamp!: ' + repr(stamp))
+            counts['rejected'] += 1
+            continue
+        obs.append(ob)
+        if len(obs) >= batch:
+            yield _decode(times, obs, reader, counts)
+            times = []
+            obs = []
+    if obs:
+        yield _decode(times, obs, reader, counts)
+
+
+def _decode(times, obs, reader, counts):
+    '''
+    Decode a batch of messages, and drop the ones which could not be read
+    '''
+    out = reader(obs)
+    valid = out.pop('valid')
+    counts['decoded'] += int(valid.sum())
+    counts['rejected'] += int((~valid).sum())
+    for k in PER_MESSAGE:
+        if k in out:
+            out[k] = out[k][valid]
+    return np.array(times, dtype=int)[valid], out
+
+
+def _frames(source, start, end, chunk, timestamp_after):
+    '''
+    Generator of (timestamp, message) text pairs from a log file, where a
+    message is the text between the start and end characters, and the
+    timestamp is the nearest line of text outside of it.
+    '''
+    if isinstance(source, basestring):
+        handle = open(source, 'r')
+    else:
+        handle = source
+    pending = ''
+    eof = False
+    try:
+        while not eof:
+            data = handle.read(chunk)
+            eof = not data
+            pending += data
+            pos = 0
+            while True:
+                s = pending.find(start, pos)
+                if s < 0:
+                    break
+                e = pending.find(end, s)
+                if e < 0:
+                    if len(pending) - s > MAX_MESSAGE:
+                        # this message lost its end, skip to the next one
+                        pos = s + 1
+                        continue
+                    break
+                # a lost end character leaves a second start within the frame
+                s = pending.rfind(start, s, e)
+                if timestamp_after:
+                    n = pending.find(start, e)
+                    if n < 0:
+                        if not eof:
+                            # the timestamp may not have been read yet
+                            break
+                        n = len(pending)
+                    lines = pending[e + 1:n].strip().splitlines()
+                    stamp = lines[0] if lines else ''
+                    next_pos = n
+                else:
+                    lines = pending[pos:s].strip().splitlines()
+                    stamp = lines[-1] if lines else ''
+                    next_pos = e + 1
+                yield stamp.strip(), pending[s + 1:e].strip()
+                pos = next_pos
+            pending = pending[pos:]
+            if pending.find(start) < 0 and len(pending) > MAX_MESSAGE:
+                # no messages in here, so only a timestamp could be kept
+                pending = pending[-MAX_MESSAGE:]
+    finally:
+        if handle is not source:
+            handle.close()
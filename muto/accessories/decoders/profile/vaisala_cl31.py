@@ -4,7 +4,23 @@ Created on Jan 27, 2013
 @author: jyoung
 '''
 import numpy as np
+from muto.accessories import instrument
 
+# translation table from ascii character codes to hexadecimal digit values,
+# any character which is not a hexadecimal digit is marked with -1
+_HEX_DIGITS = np.zeros(256, dtype=np.int64) - 1
+for _i, _c in enumerate('0123456789abcdef'):
+    _HEX_DIGITS[ord(_c)] = _i
+    _HEX_DIGITS[ord(_c.upper())] = _i
+del _i, _c
+
+OB_LENGTH = 770  # FIXME - the current return length is limited to 770
+SCALING_FACTOR = 1.0e9
+# determine height difference by reading the last digit of the code
+HEIGHT_CODES = [0, 10, 20, 5, 5]  # '0' is not a valid key, and will not happen
+DATA_LENGTHS = [0, 770, 385, 1500, 770]  # length between 770 and 1500
+
+@instrument.timed('cl31.read')
 def read(ob):
     '''
     Read and translate a single Vaisala CL31 message 2(?) observation text
@@ -27,11 +43,130 @@ def read(ob):
             information, and status information. It is possible to get more
             information from these lines with a revision of this code.
     '''
-    OB_LENGTH = 770  # FIXME - the current return length is limited to 770
-    SCALING_FACTOR = 1.0e9
     'break the full ob text into it\'s constituent parts'
-    p1 = ob.split(unichr(002))
-    p2 = p1[1].split(unichr(003))
+    code, status, prof = _split(ob)
+    datLen = DATA_LENGTHS[int(code[-1])]
+    htMult = HEIGHT_CODES[int(code[-1])]
+    values = np.zeros(datLen, dtype=np.float32)
+    # scaled to 100000sr/km (x1e9 sr/m)FYI
+    decoded = decode_hex_array(prof, 5, 20)
+    values[:decoded.shape[0]] = decoded
+
+    # then the storage will be log10'd values
+    values[values <= 0] = 1.
+    out = {
+        'height':np.arange(0, 10000, htMult)[:OB_LENGTH],
+        'bs':np.log10(values[:OB_LENGTH] / SCALING_FACTOR),
+        'status':status
+        }
+    return out
+
+@instrument.timed('cl31.read_batch', lambda out: out['bs'].shape[0])
+def read_batch(obs):
+    '''
+    Read and translate many Vaisala CL31 observations at once, filling
+    preallocated (observation x gate) arrays instead of returning one small
+    dict per message.
+
+    Messages are grouped by their height resolution code, and every group
+    with complete profiles is decoded with a single array operation.
+
+    Parameters
+    ----------
+    obs: list or str
+        either a sequence of individual message texts, as would be given to
+        read(), or a single buffer holding many messages, each framed by the
+        begin/end comms control characters (SOH and EOT)
+
+    Returns
+    -------
+    dict : 'bs', 'status', 'valid', 'resolution', 'height'
+        'bs': float32 array (n_obs x 770) of log10'd bs values as given by
+            read(). Gates a message does not report (20 m resolution) and
+            rows which could not be read are NaN
+        'status': float32 array (n_obs x 13) of status values, NaN for
+            unread rows
+        'valid': boolean array (n_obs) marking successfully read messages
+        'resolution': int array (n_obs) of the vertical resolution of each
+            message in meters, 0 for unread rows
+        'height': range indices shared by the valid messages, or None if the
+            batch mixes height resolutions (see 'resolution')
+    '''
+    if isinstance(obs, basestring):
+        # keep only the text between the begin and end comms characters
+        obs = [ob.split('\x04')[0]
+               for ob in obs.split('\x01')[1:]]
+    count = len(obs)
+    bs = np.empty((count, OB_LENGTH), dtype=np.float32)
+    bs.fill(np.nan)
+    status = np.empty((count, 13), dtype=np.float32)
+    status.fill(np.nan)
+    valid = np.zeros(count, dtype=bool)
+    resolution = np.zeros(count, dtype=int)
+
+    # parse the text of every message, and group the profiles by code
+    groups = {}
+    for i, ob in enumerate(obs):
+        try:
+            code, st, prof = _split(ob)
+            key = int(code[-1])
+            if not DATA_LENGTHS[key] or st.shape[0] != 13:
+                continue
+        except (IndexError, ValueError):
+            continue
+        status[i] = st
+        groups.setdefault(key, []).append((i, prof))
+
+    for key in groups:
+        datLen = DATA_LENGTHS[key]
+        values = np.zeros((len(groups[key]), datLen), dtype=np.float32)
+        rows = np.array([i for i, prof in groups[key]])
+        ok = np.ones(rows.shape[0], dtype=bool)
+        full = [j for j, (i, prof) in enumerate(groups[key])
+                if len(prof) == datLen * 5]
+        try:
+            # complete profiles are decoded together as one long string
+            values[full] = decode_hex_array(
+                ''.join([groups[key][j][1] for j in full]), 5, 20
+                ).reshape(len(full), datLen)
+            full = set(full)
+        except ValueError:
+            # a bad character somewhere, so fall back to single profiles
+            full = set()
+        for j, (i, prof) in enumerate(groups[key]):
+            if j in full:
+                continue
+            try:
+                decoded = decode_hex_array(prof, 5, 20)
+                values[j, :decoded.shape[0]] = decoded
+            except ValueError:
+                ok[j] = False
+        values[values <= 0] = 1.
+        gates = min(datLen, OB_LENGTH)
+        bs[rows[ok], :gates] = np.log10(values[ok, :OB_LENGTH] / SCALING_FACTOR)
+        status[rows[~ok]] = np.nan
+        valid[rows[ok]] = True
+        resolution[rows[ok]] = HEIGHT_CODES[key]
+
+    resolutions = np.unique(resolution[valid])
+    height = None
+    if resolutions.shape[0] == 1:
+        height = np.arange(0, 10000, resolutions[0])[:OB_LENGTH]
+    return {
+        'bs':bs,
+        'status':status,
+        'valid':valid,
+        'resolution':resolution,
+        'height':height,
+        }
+
+def _split(ob):
+    '''
+    Break a single CL31 message into the height code, the transcribed
+    status values and the hexadecimal profile string.
+    '''
+    p1 = ob.split('\x02')
+    p2 = p1[1].split('\x03')
     code = p1[0].strip()
     ob = p2[0].strip()  # just contents between B and C
     # unused currently checksum = p2[1].strip()
@@ -49,29 +184,7 @@ def read(ob):
                     sl1[2:-13].replace('/', '0').split() + sl2[:-14].split(),
                     dtype=np.float32)
     'status should have a length of 13... we shall see...'
-    # determine height difference by reading the last digit of the code
-    height_codes = [0, 10, 20, 5, 5]  # '0' is not a valid key, and will not happen
-    data_lengths = [0, 770, 385, 1500, 770]
-    'length between 770 and 1500'
-    datLen = data_lengths[int(code[-1])]
-    htMult = height_codes[int(code[-1])]
-    values = np.zeros(datLen, dtype=np.float32)
-    ky = 0
-    for i in xrange(0, len(prof), 5):
-
-        ven = prof[i:i + 5]
-
-        values[ky] = twos_comp(int(ven, 16), 20)  # scaled to 100000sr/km (x1e9 sr/m)FYI
-        ky += 1  # keep the key up to date
-
-    # then the storage will be log10'd values
-    values[values <= 0] = 1.
-    out = {
-        'height':np.arange(0, 10000, htMult)[:OB_LENGTH],
-        'bs':np.log10(values[:OB_LENGTH] / SCALING_FACTOR),
-        'status':status
-        }
-    return out
+    return code, status, prof
 
 def decode_hex_string(string, fail_value=1, char_count=5, use_filter=True):
     '''
@@ -101,19 +214,52 @@ def decode_hex_string(string, fail_value=1, char_count=5, use_filter=True):
     value if you wish it to be something else. Negative values will incur NaNs.
     '''
     data_len = len(string)
-    data = np.zeros(data_len / char_count, dtype=int)
-    key = 0
-    # though ugly, using a key seems like a more reliable way to record indices.
-    for i in xrange(0, data_len, char_count):
-        hex_string = string[i:i + char_count]
-        data[key] = twos_comp(int(hex_string, 16), 20)
-        key += 1
+    data = decode_hex_array(string[:data_len - data_len % char_count],
+                            char_count, 20)
     # apply value filters if required
     if use_filter:
         data[data <= 0] = fail_value
         data = np.log10(data) - 9.
     return data
 
+def decode_hex_array(string, char_count=5, bits=20):
+    '''
+    Translate a string of fixed width hexadecimal values into signed integers
+    using array operations, rather than calling int() for every value.
+
+    The string is viewed as a byte array, every character is mapped to its
+    digit value through a lookup table, and the digits of each value are
+    combined with a single dot product before the two's complement is taken.
+
+    Parameters
+    ----------
+    string: str
+        newline free string of hexadecimal values, char_count digits each. A
+        trailing partial value is translated as if it were a whole one, which
+        matches what int(string[i:i + char_count], 16) would give.
+    char_count: int, optional
+        the number of characters per value. For a CL31 this is 5
+    bits: int, optional
+        the bit width used when computing the two's complement
+
+    Returns
+    -------
+    numpy int64 array of the signed values
+    '''
+    if isinstance(string, unicode):
+        string = string.encode('ascii')
+    digits = _HEX_DIGITS[np.frombuffer(string, dtype=np.uint8)]
+    if (digits < 0).any():
+        raise ValueError('invalid hexadecimal character in profile string')
+    count, extra = divmod(digits.shape[0], char_count)
+    weights = 16 ** np.arange(char_count - 1, -1, -1, dtype=np.int64)
+    values = np.dot(digits[:count * char_count].reshape(count, char_count),
+                    weights)
+    if extra:
+        values = np.append(values, np.dot(digits[-extra:], weights[-extra:]))
+    # vectorized version of twos_comp below
+    return values - (((values >> (bits - 1)) & 1) << bits)
+
 # I thanks Travc at stack overflow for this method of converting values
 # See here: http://stackoverflow.com/questions/1604464/twos-complement-in-python
 
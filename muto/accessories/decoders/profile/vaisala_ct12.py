@@ -3,8 +3,25 @@ Created on Jan 27, 2013
 
 @author: jyoung
 '''
-from numpy import exp, zeros, float32, array, arange, uint8
+from numpy import exp, zeros, float32, array, arange, uint8, int64, \
+    frombuffer, empty, nan
+from muto.accessories import instrument
 
+# translation table from ascii character codes to hexadecimal digit values,
+# any character which is not a hexadecimal digit is marked with -1
+_HEX_DIGITS = zeros(256, dtype=int64) - 1
+for _i, _c in enumerate('0123456789abcdef'):
+    _HEX_DIGITS[ord(_c)] = _i
+    _HEX_DIGITS[ord(_c.upper())] = _i
+del _i, _c
+
+# the joined data lines of a complete message: 13 lines of a 2 character
+# height index followed by (up to) 20 two character values
+DATA_LENGTH = 526
+# cache of gather indices, keyed by the length of the joined data string
+_GATHER = {}
+
+@instrument.timed('ct12.read')
 def read(ob, doFilter=True):
     """
         Process a CT12 data message. This will read both the message and 
@@ -12,7 +29,162 @@ def read(ob, doFilter=True):
         method for reading CL31 messages.
     """
     # check if the text you have been given is a proper ct12 message:
+    parts = _split(ob)
+    if not parts:
+        return False
+    status, string = parts
+    if doFilter:
+        values = zeros((250), dtype=float32)
+    else:
+        values = zeros((250), dtype=uint8)
+    '250 is the only length this msg can be'
+    decoded = decode_pairs(string)
+    if doFilter:
+        values[:decoded.shape[0]] = (decoded - 1) / 50.  # compute the SS value...
+        values = exp(values)
+    else:
+        values[:decoded.shape[0]] = decoded
+    out = {
+           'height':arange(250) * 15,
+           'bs':values,
+           'status':status,
+           }  # 15 m vertical resolution is the only reportable form!
+
+    return out
+
+@instrument.timed('ct12.read_batch', lambda out: out['bs'].shape[0])
+def read_batch(obs, doFilter=True):
+    """
+    Process many CT12 data messages at once, filling preallocated
+    (observation x 250) arrays rather than creating a dict per message.
+
+    Messages with a complete data block are stacked and decoded with a
+    single gather over all of them, anything else is read individually.
+
+    Parameters
+    ----------
+    obs: list
+        the CT12 message texts, as would be given to read()
+    doFilter: bool, optional
+        compute backscatter as read() does, otherwise the raw byte values
+        are returned
+
+    Returns
+    -------
+    dict : 'bs', 'status', 'valid', 'height'
+        'bs': (n_obs x 250) array, float32 (NaN for unread rows) or uint8
+            (0 for unread rows) if doFilter is False
+        'status': (n_obs x 26) float32 array, NaN for unread rows
+        'valid': boolean array (n_obs) marking successfully read messages
+        'height': the 15 m range indices
+    """
+    count = len(obs)
+    if doFilter:
+        bs = empty((count, 250), dtype=float32)
+        bs.fill(nan)
+    else:
+        bs = zeros((count, 250), dtype=uint8)
+    status = empty((count, 26), dtype=float32)
+    status.fill(nan)
+    valid = zeros(count, dtype=bool)
+
+    full = []
+    for i, ob in enumerate(obs):
+        try:
+            parts = _split(ob)
+            if not parts:
+                continue
+            st, string = parts
+            if len(string) == DATA_LENGTH:
+                # stack this one with the other complete messages
+                full.append((i, st, string))
+                continue
+            decoded = decode_pairs(string)
+        except (IndexError, ValueError):
+            continue
+        # unreported gates stay 0 before the exp, exactly as in read()
+        bs[i] = 0
+        if doFilter:
+            bs[i, :decoded.shape[0]] = (decoded - 1) / 50.
+        else:
+            bs[i, :decoded.shape[0]] = decoded
+        status[i], valid[i] = st, True
+
+    if full:
+        rows = array([i for i, st, string in full])
+        sts = array([st for i, st, string in full])
+        try:
+            # (count x values), even for a single message
+            values = decode_pairs(''.join([string for i, st, string in full]),
+                                  len(full)).reshape(len(full), -1)
+        except ValueError:
+            # a bad character somewhere, so check the messages one at a time
+            values = zeros((rows.shape[0], 250), dtype=int64)
+            for j, (i, st, string) in enumerate(full):
+                try:
+                    values[j] = decode_pairs(string)
+                except ValueError:
+                    rows[j] = -1
+        keep = rows >= 0
+        if doFilter:
+            bs[rows[keep]] = (values[keep] - 1) / 50.
+        else:
+            bs[rows[keep]] = values[keep]
+        status[rows[keep]] = sts[keep]
+        valid[rows[keep]] = True
 
+    if doFilter:
+        bs[valid] = exp(bs[valid])
+    return {
+           'height':arange(250) * 15,
+           'bs':bs,
+           'status':status,
+           'valid':valid,
+           }
+
+def decode_pairs(string, count=1):
+    """
+    Translate the joined CT12 data lines into the 250 backscatter bytes in
+    one array operation, rather than looping through the two character
+    pairs and skipping the height indices.
+
+    Parameters
+    ----------
+    string: str
+        the data lines joined together, with spaces replaced by 0s. This may
+        also be count equal length strings joined end to end.
+    count: int, optional
+        the number of messages in string
+
+    Returns
+    -------
+    numpy int64 array of the byte values, (values) or (count x values)
+    """
+    if isinstance(string, unicode):
+        string = string.encode('ascii')
+    length = len(string) / count
+    if length not in _GATHER:
+        # every pair following the height index begins at an even position
+        index = array([i for i in xrange(2, length - 1, 2) if i % 42 != 0],
+                      dtype=int)
+        if index.shape[0] > 250:
+            raise IndexError('too many values for a CT12 profile')
+        _GATHER[length] = index
+    index = _GATHER[length]
+    digits = _HEX_DIGITS[frombuffer(string, dtype=uint8)].reshape(count, length)
+    high, low = digits[:, index], digits[:, index + 1]
+    if (high < 0).any() or (low < 0).any():
+        raise ValueError('invalid hexadecimal character in profile string')
+    values = high * 16 + low
+    if count == 1:
+        return values[0]
+    return values
+
+def _split(ob):
+    """
+    Break a CT12 message into the transcribed status values and the joined
+    data line string. False is returned if the message is not a CT12 message
+    """
     dls = ob.split("\n")
     dl = []
     if len(dls) < 15 or ":" in ob:
@@ -39,31 +211,9 @@ def read(ob, doFilter=True):
         if '/' in x: return 0.
         return float(x)
     status = array(map(to, data), dtype=float32)
-    if doFilter:
-        values = zeros((250), dtype=float32)
-    else:
-        values = zeros((250), dtype=uint8)
-    '250 is the only length this msg can be'
     'Join the split up data lines back together to read in more easily and reformat'
     string = '\n'.join(dl[2:]).replace(' ', '0').replace("\n", "").replace("\r", "").strip()
-    index = 0
-    for i in xrange(2, len(string[2:]) + 1, 2):
-        if i % 42 == 0: continue  # height indices
-        if doFilter:
-            val = (int(string[i:i + 2], 16) - 1) / 50.  # compute the SS value...
-        else:
-            val = int(string[i:i + 2], 16)
-        values[index] = val
-        index += 1
-    if doFilter:
-        values = exp(values)
-    out = {
-           'height':arange(250) * 15,
-           'bs':values,
-           'status':status,
-           }  # 15 m vertical resolution is the only reportable form!
-
-    return out
+    return status, string
 
 def decode_hex_string(string):
     '''
@@ -0,0 +1,146 @@
+'''
+Lightweight timing and counters for the storage and decoding hot paths.
+
+Functions wrapped with timed() record their number of calls, the number of
+items (rows, obs) they handled, errors, and the total and longest time taken,
+into the process wide stats. Recording is off by default, when a wrapped
+function costs only one extra call and check. Turn it on with enable(), or
+by setting the MUTO_INSTRUMENT environment variable, and read the results
+with snapshot() or log():
+
+    >>> from muto.accessories import instrument
+    >>> instrument.enable()
+    >>> # ... ingest some data ...
+    >>> instrument.log()
+
+Stats are kept per process, so the decoding done in the workers of
+ingest_files is not seen by the parent.
+'''
+import os
+import time
+import functools
+import logging as l
+
+# is recording turned on
+enabled = bool(os.environ.get('MUTO_INSTRUMENT'))
+# name: [calls, items, errors, total seconds, longest seconds]
+stats = {}
+
+
+def enable(on=True):
+    '''
+    Turn recording on (or off)
+    '''
+    global enabled
+    enabled = bool(on)
+
+
+def disable():
+    '''
+    Turn recording off, keeping the stats recorded so far
+    '''
+    enable(False)
+
+
+def reset():
+    '''
+    Clear all of the recorded stats
+    '''
+    stats.clear()
+
+
+def record(name, seconds, items=1, errors=0):
+    '''
+    Record one call of name, if recording is on
+
+    Parameters
+    ----------
+    name: str
+        what was timed, e.g. 'h5.append'
+    seconds: float
+        the time it took
+    items: int, optional
+        the number of rows, obs, etc. it handled
+    errors: int, optional
+        1 if the call raised an error
+    '''
+    if not enabled:
+        return
+    s = stats.get(name)
+    if s is None:
+        s = stats[name] = [0, 0, 0, 0., 0.]
+    s[0] += 1
+    s[1] += items
+    s[2] += errors
+    s[3] += seconds
+    if seconds > s[4]:
+        s[4] = seconds
+
+
+def timed(name, count=None):
+    '''
+    Decorator recording the calls of a function under name.
+
+    Parameters
+    ----------
+    name: str
+        the name the calls are recorded under
+    count: function, optional
+        given the return value of the function, returns the number of items
+        it handled. By default every call is one item.
+    '''
+    def wrap(func):
+        @functools.wraps(func)
+        def timer(*args, **kwargs):
+            if not enabled:
+                return func(*args, **kwargs)
+            stime = time.time()
+            try:
+                out = func(*args, **kwargs)
+            except:
+                record(name, time.time() - stime, 0, 1)
+                raise
+            record(name, time.time() - stime, count(out) if count else 1)
+            return out
+        return timer
+    return wrap
+
+
+def snapshot(clear=False):
+    '''
+    The recorded stats, as a dict of name: {'calls', 'items', 'errors',
+    'total', 'mean', 'max'}, with times in seconds
+
+    Parameters
+    ----------
+    clear: bool, optional
+        reset the stats after taking the snapshot
+    '''
+    out = {}
+    for name, s in stats.items():
+        out[name] = {'calls':s[0], 'items':s[1], 'errors':s[2], 'total':s[3],
+                     'mean':s[3] / s[0] if s[0] else 0., 'max':s[4]}
+    if clear:
+        reset()
+    return out
+
+
+def log_line(clear=False):
+    '''
+    The recorded stats as a single line of text, slowest total first
+    '''
+    snap = snapshot(clear)
+    names = sorted(snap, key=lambda n: -snap[n]['total'])
+    return '; '.join(['%s: %d calls %d items %d errors %.3fs '
+                      '(mean %.2fms max %.2fms)' % (
+                          n, snap[n]['calls'], snap[n]['items'],
+                          snap[n]['errors'], snap[n]['total'],
+                          snap[n]['mean'] * 1000, snap[n]['max'] * 1000)
+                      for n in names])
+
+
+def log(level=l.INFO, clear=False):
+    '''
+    Write the recorded stats to the log
+    '''
+    l.log(level, 'instrument: ' + log_line(clear))
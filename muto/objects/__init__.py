@@ -1,23 +1,4 @@
-class GenericProfile(DataObject):
-	'''
-	The profile class extends the DataObject class by adding a couple 
-	methods to handle processing generic profile data, where what is passed
-	is a numpy array of data values, meant to be stored.
-	'''
-	
-class PointProfie(DataObject):
-	'''
-	The PointProfile class extends the DataObject for measurements like soundings.
-	
-	A profile composed of numerous points in the atmosphere, therefore spatial 
-	position is also included as important information. Numerous variables are 
-	recorded about each point, as well, both the profile overall has a timestamp
-	as well as each individual observation. 
-	
-	Variable collections are dynamic, and will have default values such that they
-	can be absent.
-	'''
-
+import numpy as np
 
 
 class DataObject(object):
@@ -54,8 +35,196 @@ class DataObject(object):
 		self.name=name
 	def write(self):
 		'Ensure the branch written to is of the same type as this ob. '
-		
+
+
+class GenericProfile(DataObject):
+	'''
+	The profile class extends the DataObject class by adding a couple 
+	methods to handle processing generic profile data, where what is passed
+	is a numpy array of data values, meant to be stored.
+	'''
 	
+class PointProfie(DataObject):
+	'''
+	The PointProfile class extends the DataObject for measurements like soundings.
 	
-		
+	A profile composed of numerous points in the atmosphere, therefore spatial 
+	position is also included as important information. Numerous variables are 
+	recorded about each point, as well, both the profile overall has a timestamp
+	as well as each individual observation. 
 	
+	Variable collections are dynamic, and will have default values such that they
+	can be absent.
+	'''
+
+
+class ProfileBatch(GenericProfile):
+	'''
+	Many profiles of the same kind held together as columns, rather than one
+	object per profile. Every variable is a contiguous array with one row per
+	profile (time x height for profile data), and the height and any other
+	index arrays are shared by all of the profiles.
+
+	Indexing a batch with an integer, slice, boolean mask or index array
+	returns a new batch of the selected profiles (slices are views), and
+	indexing with a variable name returns that variable's array.
+	'''
+	def __init__(self, name, time, height=None, indices=None, **variables):
+		'''
+		Parameters
+		----------
+		name: str
+			identifies the kind of profile, e.g. the instrument
+		time: array
+			epoch time of each profile
+		height: array, opt
+			the height of every gate, shared by all of the profiles
+		indices: dict, opt
+			other time independent arrays, stored as h5 indices
+		**variables:
+			name=array values, each with one row per time
+		'''
+		DataObject.__init__(self, name, None)
+		self.time = np.asarray(time)
+		self.indices = dict(indices or {})
+		if height is not None:
+			self.indices['height'] = np.asarray(height)
+		self.variables = {}
+		for k in variables:
+			self.variables[k] = np.asarray(variables[k])
+			if self.variables[k].shape[0] != self.time.shape[0]:
+				raise ValueError('variable ' + k + ' does not have one row per time')
+
+	@classmethod
+	def allocate(cls, name, count, height=None, indices=None, fill=np.nan,
+				 **shapes):
+		'''
+		Create a batch of count profiles, with every variable filled with the
+		fill value, and the times with 0, for a decoder to fill in place.
+
+		Parameters
+		----------
+		**shapes:
+			name=shape values, the shape of one profile of each variable
+		'''
+		variables = {}
+		for k in shapes:
+			variables[k] = np.empty((count,) + tuple(np.atleast_1d(shapes[k])),
+									dtype=np.float32)
+			variables[k].fill(fill)
+		return cls(name, np.zeros(count, dtype=np.int64), height, indices,
+				   **variables)
+
+	@classmethod
+	def from_decoder(cls, name, time, out, variables=('bs', 'status')):
+		'''
+		Create a batch from the output of a batch decoder (e.g.
+		vaisala_cl31.read_batch or logfile.iter_log), keeping only the valid
+		profiles, without copying when all are valid.
+		'''
+		batch = cls(name, time, out.get('height'),
+					**dict([(k, out[k]) for k in variables]))
+		if 'valid' in out and not out['valid'].all():
+			return batch[out['valid']]
+		return batch
+
+	@classmethod
+	def from_slice(cls, name, rows, height=None, indices=None):
+		'''
+		Create a batch from the structured array returned by h5.slice
+		'''
+		return cls(name, rows['time'], height, indices,
+				   **dict([(k, rows[k]) for k in rows.dtype.names if k != 'time']))
+
+	@classmethod
+	def concatenate(cls, batches):
+		'''
+		Join batches of the same variables and indices into one, in the order
+		given.
+		'''
+		first = batches[0]
+		for b in batches[1:]:
+			if sorted(b.variables) != sorted(first.variables):
+				raise ValueError('batches do not hold the same variables')
+			for k in first.indices:
+				if k not in b.indices or not np.array_equal(b.indices[k],
+															first.indices[k]):
+					raise ValueError('batches do not share the index ' + k)
+		return cls(first.name, np.concatenate([b.time for b in batches]),
+				   indices=first.indices,
+				   **dict([(k, np.concatenate([b.variables[k] for b in batches]))
+						   for k in first.variables]))
+
+	@property
+	def height(self):
+		return self.indices.get('height')
+
+	def __len__(self):
+		return self.time.shape[0]
+
+	def __getitem__(self, key):
+		if isinstance(key, basestring):
+			return self.variables[key]
+		if isinstance(key, (int, np.integer)):
+			key = slice(key, key + 1 or None)
+		return self.__class__(self.name, self.time[key], indices=self.indices,
+							  **dict([(k, v[key]) for k, v in self.variables.items()]))
+
+	def select(self, begin=None, end=None):
+		'''
+		The profiles with times from begin to end (inclusive), a view if the
+		times are sorted
+		'''
+		if (np.diff(self.time) >= 0).all():
+			first = 0 if begin is None else self.time.searchsorted(begin, 'left')
+			last = len(self) if end is None else self.time.searchsorted(end, 'right')
+			return self[first:last]
+		mask = np.ones(len(self), dtype=bool)
+		if begin is not None:
+			mask &= self.time >= begin
+		if end is not None:
+			mask &= self.time <= end
+		return self[mask]
+
+	def sort(self):
+		'''
+		The profiles in time order
+		'''
+		return self[np.argsort(self.time, kind='mergesort')]
+
+	def write(self, archive, group='/', persist=False):
+		'''
+		Write every profile to an h5 archive with a single append, creating
+		the dataset (and saving the indices) if it does not exist yet.
+
+		Parameters
+		----------
+		archive: muto.storage.h5.h5
+			the archive written to
+		group: str, opt
+			the group of the dataset
+		persist: bool, opt
+			leave the archive open for further writes
+
+		Returns
+		-------
+		count: int
+			the number of profiles written
+		'''
+		# only writing needs PyTables
+		import tables
+		try:
+			count = archive.append_many(self.time, persist=True, group=group,
+										**self.variables)
+		except tables.NoSuchNodeError:
+			archive.close()
+			archive.create(group=group,
+						   indices=dict([(k, v.shape) for k, v in self.indices.items()]),
+						   **dict([(k, v.shape[1:]) for k, v in self.variables.items()]))
+			if self.indices:
+				archive.save_indices(group, **self.indices)
+			count = archive.append_many(self.time, persist=True, group=group,
+										**self.variables)
+		if not persist:
+			archive.close()
+		return count
@@ -1 +1 @@
-all = ['h5']
\ No newline at end of file
+all = ['h5', 'ingest', 'partition', 'sites']
\ No newline at end of file
@@ -11,12 +11,29 @@ import tables
 import time
 import os
 import fcntl
+import collections
+import uuid
 import muto
+from muto.accessories import instrument
 import numpy as np
 import logging as l
 l.basicConfig(level=l.DEBUG,
     format='%(asctime)s: %(levelname)s: %(message)s', datefmt='%m/%d/%Y %H:%M:%S')
 
+# default aggregate level bin lengths, 5 minutes, 1 hour and 1 day
+LEVELS = (300, 3600, 86400)
+# number of rows read from a table at a time by slices
+READ_ROWS = 10000
+# number of writes kept in the change log of each group
+CHANGE_LOG = 64
+# the stored value of missing (NaN or -9999.) values in int16 variables
+MISSING_INT16 = -32768
+# number of appended times the dedupe mode keeps aside before merging them
+# into the sorted times of a group
+DEDUPE_BUFFER = 1024
+# default scale factors of the quantized storage types
+QUANTIZED = {'int16':0.001, 'float16':1.}
+
 
 
 class h5(object):
@@ -24,7 +41,8 @@ class h5(object):
     Class for interacting with HDF5 files in the format created by this class
     '''
 
-    def __init__(self, fname):
+    def __init__(self, fname, shared=False, cache=False, dedupe=False,
+                 sort_buffer=0):
         """
         Create the object for interaction by simply providing the location of 
         the HDF5 document
@@ -33,13 +51,62 @@ class h5(object):
         ----------
         fname : str
             String location of HDF5 source file (.h5,hdf5,etc...)
+        shared : bool, optional (default=False)
+            use the reader/writer concurrency mode, where readers hold a
+            shared lock while reading, and a writer only excludes them while
+            flushing. Readers then only see the rows which were flushed.
+            Otherwise a writer locks the file exclusively while it is open.
+        cache : bool, optional (default=False)
+            keep the results of slice in the process wide slice_cache, so
+            that repeated slices are not read from the file again
+        dedupe : bool, optional (default=False)
+            reject appended rows whose time is already in the dataset (or
+            earlier in the same batch). The times of each group appended to
+            are loaded once into a sorted array, and kept up to date with
+            the appends, so checking a batch does not query the table.
+        sort_buffer : int, optional (default=0)
+            collect up to this many appended rows before writing them, in
+            time order, so that the table stays sorted even when rows arrive
+            out of order. Rows older than the end of the table are merged
+            into it, rewriting only the rows after them. Buffered rows are
+            written when the buffer is full, and by flush and close, though
+            in the shared mode only by flush and close.
             
+        Note
+        ----
+        The shared mode is cooperative, every reader and writer of the file
+        should use it. Only one writer may have the file open at a time. The
+        locks are kept on a separate file, <fname>.lock, see SharedLock.
         """
         self.filename = fname
         self.doc = NullDoc()
+        self.shared = shared
+        self.cache = cache
+        self.dedupe = dedupe
+        self.sort_buffer = sort_buffer
+        self.lock = None
+        # seconds waited for the last lock this object acquired
+        self.locktime = 0.
+        # extents of the groups appended to, which are not yet saved
+        self.extents = {}
+        # True when self.doc is a handle shared through the read pool
+        self.pooled = False
+        # aggregate levels of the groups, and the bins of each level
+        # appended to since the levels were last updated
+        self.levels = {}
+        self.dirty_levels = {}
+        # the time range appended to each group since the last save
+        self.touched = {}
+        # the sorted times of each group, the sorted times appended since
+        # they were merged, and the row count, for the dedupe mode
+        self.times = {}
+        # rows buffered for each group, and how many, with a sort_buffer
+        self.pending = {}
+        self.pending_rows = {}
 
     def create(self, close=True, clear=False, indices=False, group='/',
-               **variables):
+               levels=False, codec='zlib', complevel=6, shuffle=True,
+               chunkrows=None, storage=None, ragged=False, **variables):
         """
         Create an HDF5 document formatted for the provided variables
         
@@ -55,16 +122,61 @@ class h5(object):
             group: str,opt
                 The textual representation of the group the dataset will 
                 reside in
+            levels: bool or list, opt
+                Keep downsampled aggregate levels of the data, a list of bin
+                lengths in seconds, or True for LEVELS (5 minutes, 1 hour and
+                1 day). Each level is a table 'level_<seconds>' next to the
+                data table holding the count and the mean, min and max of
+                every variable in each time bin, see slice(resolution=).
+            codec: str, opt
+                the compression library, 'zlib' (default), 'lzo', 'bzip2',
+                'blosc' or a blosc compressor such as 'blosc:lz4' or
+                'blosc:zstd', or None for no compression
+            complevel: int, opt
+                the compression level, 0-9 (default=6)
+            shuffle: bool or str, opt
+                True (or 'byte') for the byte shuffle filter, 'bit' for the
+                bit shuffle filter (blosc codecs only), or False for neither
+            chunkrows: int, opt
+                the number of rows in each chunk of the tables, 1 to read
+                single obs quickly, or more for better compression. By default
+                PyTables chooses.
+            storage: dict, opt
+                {'name':type} values to store variables more compactly than
+                float32, where type is 'float16', 'int16', or a tuple of
+                ('int16', scale, offset) to store round((value - offset) /
+                scale). The default int16 scale is 0.001 with no offset, which
+                keeps 3 decimal places between -32.767 and 32.767. Values are
+                converted on append and back to float32 by slice and dump,
+                though missing values are read as NaN rather than -9999.
+            ragged: bool, opt
+                store profiles with a varying number of points, such as
+                soundings. The variables are then those of each point, kept
+                in a flat 'points' table with the time of each point, and the
+                data table holds the time of each profile and the start and
+                count of its points. See append_profiles and slice_ragged.
+                Aggregate levels are not available for ragged datasets.
             **variables:
                 name=[length,length,...] values to state the expandable 
                 variables for the dataset
         """
+        # 'Identify the compression filters we are going to want to use'
+        filters = storage_filters(codec, complevel, shuffle)
+        chunkshape = (chunkrows,) if chunkrows else None
+        storage = dict([(k, storage_spec(v)) for k, v in
+                        (storage or {}).items()])
+        if ragged and levels:
+            raise ValueError('aggregate levels are not available for ragged '
+                             + 'datasets')
 
-        if clear:
+        if clear and self.shared:
+            self.doc, self.lock = h5open_shared(self.filename, 'w')
+        elif clear:
             # then force the document open with write permissions
             self.doc, self.lock = h5openw(self.filename)
         else:
-            self.doc, self.lock = h5opena(self.filename)
+            self.opena()
+        self._hold_data()
 
         # Create the group the data is going to sit in'
         if group  is not '/':
@@ -77,9 +189,6 @@ class h5(object):
             except:
                 # Assume the group already exists.
                 pass
-        # 'Identify the compression filters we are going to want to use'
-        filters = tables.Filters(complevel=6, complib='zlib')
-        # Using BLOSC Compression, which is the default in newer builds.
         '''
         for now, index information is expected to be fixed, or else it should 
         be a variable, so I will leave it as a Carray.
@@ -106,31 +215,83 @@ class h5(object):
         i = 2
         for k in variables:
             'data shape is equivalent to all the additional dimensions'
-            table_description[k] = tables.Float32Col(shape=variables[k], pos=i,
-                                                   dflt= -9999.)
+            if k not in storage:
+                table_description[k] = tables.Float32Col(shape=variables[k],
+                                                         pos=i, dflt= -9999.)
+            elif storage[k][0] == 'int16':
+                table_description[k] = tables.Int16Col(shape=variables[k],
+                                            pos=i, dflt=MISSING_INT16)
+            else:
+                table_description[k] = tables.Float16Col(shape=variables[k],
+                                                         pos=i, dflt=np.nan)
             i += 1
+        if ragged:
+            # the points table holds the variables, and the data table where
+            # the points of each profile are
+            self.doc.createTable(group, 'points', table_description,
+                                 filters=filters.copy(), chunkshape=chunkshape)
+            table_description = {'time': tables.Int32Col(pos=1),
+                                 'start': tables.Int64Col(pos=2),
+                                 'count': tables.Int32Col(pos=3)}
+            chunkshape = None
         'create the table, disregard that it returns a table object'
         self.doc.createTable(group, 'data', table_description,
-                                    filters=filters.copy())
+                             filters=filters.copy(), chunkshape=chunkshape)
         l.info('table created')
 
+        if levels is True:
+            levels = LEVELS
+        for seconds in levels or []:
+            level_description = {'time': tables.Int32Col(pos=1),
+                                 'count': tables.Int32Col(pos=2)}
+            i = 3
+            for k in variables:
+                for name in (k, k + '_min', k + '_max'):
+                    level_description[name] = tables.Float32Col(
+                        shape=variables[k], pos=i, dflt=np.nan)
+                    i += 1
+            self.doc.createTable(group, 'level_' + str(seconds),
+                                 level_description, filters=filters.copy(),
+                                 chunkshape=chunkshape)
+        self.doc.setNodeAttr(group, 'levels', list(levels or []))
+
         # Set file attributes
         self.doc.setNodeAttr('/', 'creator', 'Muto v' + muto.version())
         self.doc.setNodeAttr('/', 'version', '1.3')
         # Set any group attributes.
         if indices:
             self.doc.setNodeAttr(group, 'indices', indices.keys())
+        self.doc.setNodeAttr(group, 'codec', codec or 'none')
+        self.doc.setNodeAttr(group, 'complevel', filters.complevel)
+        if not filters.complevel:
+            shuffle = False
+        self.doc.setNodeAttr(group, 'shuffle', {True:'byte', 'byte':'byte',
+                                                'bit':'bit'}.get(shuffle, 'none'))
+        self.doc.setNodeAttr(group, 'chunkshape',
+                             self.doc.getNode(group).data.chunkshape)
+        self.doc.setNodeAttr(group, 'storage', storage)
+        self.doc.setNodeAttr(group, 'ragged', bool(ragged))
+        # identifies this dataset to slice caches, which may hold results of
+        # an older dataset of the same file and group
+        self.doc.setNodeAttr(group, 'created', uuid.uuid4().hex)
+        self.extents[group] = {'min_time':0, 'max_time':0, 'row_count':0,
+                               'sorted':True}
+        self._save_extents()
         # now we need to add the time values as a CS index
         self.doc.getNode(group).data.cols.time.createCSIndex(filters=filters.copy())
         # and instruct the table to auto-index
         self.doc.getNode(group).data.autoIndex = True
         if close:
-            self.doc.close()
+            self.close()
+        elif self.shared:
+            self.doc.flush()
+            self.lock.release_data()
         return True
 
+    @instrument.timed('h5.slice', lambda out: len(out))
     def slice(self, variables, begin=False, end=False, duration=False,
               timetup=False, indices=False, group='/', persist=False,
-              limit=None):
+              limit=None, resolution=False, max_points=False):
         """
         Read a specific temporal subset of various variables, as well as fetch 
         indices
@@ -156,6 +317,14 @@ class h5(object):
             'ob' is pulled duration in seconds
         group: str/group, opt
             specify the HDF5 group where this dataset exists.
+        resolution: int, opt
+            the coarsest time resolution (seconds) which is acceptable. The
+            coarsest aggregate level no longer than this is read, or the full
+            data if there is none.
+        max_points: int, opt
+            read the finest of the full data and the aggregate levels which
+            gives no more than max_points times in the window (or the
+            coarsest level, if none do)
             
         Returns
         -------
@@ -163,6 +332,12 @@ class h5(object):
             a dictionary keyed by the variables and indices given, their values
             are numpy arrays corresponding to the time sliced and ordered 
             datasets requested.
+
+            For a ragged dataset this is the RaggedSlice of slice_ragged.
+
+            When read from an aggregate level, time is the beginning of each
+            bin, the variables hold the bin means, and <variable>_min,
+            <variable>_max and count are included as well.
             
         Note
         ----
@@ -179,78 +354,46 @@ class h5(object):
         
         
         """
-        if not self.doc or not self.doc.isopen:
-            self.doc, self.lock = h5openr(self.filename)
+        self.openr()
+        if getattr(self.doc.getNode(group)._v_attrs, 'ragged', False):
+            return self.slice_ragged(variables, begin, end, duration, timetup,
+                                     group, persist=persist)
+        if self.pending and not self.shared:
+            self._merge_all()
         # Determine specified time limits
         table = self.doc.getNode(group).data
-        if timetup:
-            begin = timetup[0]
-            end = timetup[1]
-        elif duration and not end and not begin:
-            end = self.end(group, True)
-            begin = end - duration
-        elif duration and begin:
-            end = begin + duration
-        elif duration and end:
-            begin = end - duration
-        elif not duration and not begin and not end:
-            # No indicator of begin/end was given
-            raise Exception('You must specify a time tuple (timetup), '\
-                            + 'begin/end'\
-                            + ' or a duration in order to slice. Use dump() so see'\
-                            + ' an entire dataset')
-        out = {}
-        if type(variables) == str:
-            'Only one variable is requested, so we can use a prebuilt hack'
-            try:
-                varlen = table[-1][variables].shape[0]
-            except:
-                # This probably means the variable had no shape
-                varlen = 1
-
-            'a quick hack to make the most frequent requests faster'
-            out = np.array([(r['time'], r[variables])
-                            for r in table.where('(time >= ' + str(begin) \
-                                                 + ') & (time <= ' + str(end) \
-                                                 + ')')],
-                           dtype=[('time', float), (variables, 'f4', (varlen,))])
-            # FIXME - modify this for all variables.
-        elif True:
-            'sneaky way to evade that else'
-            'We are going to create a dtype structured array string'
-            dtype = [('time', float)]
-            for var in variables:
-                'determine variable length'
-                try:
-                    shp = table[-1][var].shape
-                except:
-                    shp = None
-                dtype.append((var, 'f4', shp))
-            variables = ['time'] + variables
-            'the for notation and tuple call do not seem to add monstrous overhead so far...'
-            out = np.array([tuple([r[x] for x in variables]) for r in table.where('(time >= ' + str(begin) + ') & (time <= ' + str(end) + ')')],
-                           dtype=dtype)
-
-        else:
-            result = self.doc.getNode(group).data.getWhereList('(time >= ' + str(begin) + ')&(time <= ' + str(end) + ')')
-            if len(result['time']) > 0:
-                rstart, rstop = result[0], result[-1] + 1
-                if rstop - rstart == len(result):
-                    'then we can just return all the values (skipping more refined check)'
-                    out['time'] = self.doc.getNode(group).data.read(rstart, rstop, field='time')
-                    for v in variables:
-                        out[v] = self.doc.getNode(group).data.read(rstart, rstop, field=v)
-                else:
-                    out['time'] = self.doc.getNode(group).data.readCoordinates(result, field='time')
-                    for v in variables:
-                        out[v] = self.doc.getNode(group).data.readCoordinates(result, field=v)
-            else:
-                'result length is 0'
-                self.doc.close()
-                'FIXME - raising an exception may not really be nice/necessary'
-                raise Exception('This data set does not have any data within the'\
-                                + ' times specified')
-
+        begin, end = self._window(group, begin, end, duration, timetup)
+        key = None
+        if self.cache and type(indices) == bool:
+            key = (self.filename, group,
+                   variables if type(variables) == str else tuple(variables),
+                   begin, end, resolution, max_points,
+                   getattr(self.doc.getNode(group)._v_attrs, 'created', None))
+            changes = self._changes(group)
+            out = slice_cache.get(key, changes)
+            if out is not None:
+                if not persist:
+                    self.close()
+                return out
+        # the (sorted) row coordinates of the window
+        coords = self._coords(table, group, begin, end, self._snapshot(group))
+        seconds = self._pick_level(group, begin, end, resolution, max_points,
+                                   coords.shape[0])
+        dtype = self._dtype(table, variables)
+        if seconds:
+            # read the bins of an aggregate level instead
+            table = self.doc.getNode(group, name='level_' + str(seconds))
+            coords = table.getWhereList('(time >= ' + str(begin - begin % seconds)
+                                        + ') & (time <= ' + str(end) + ')',
+                                        sort=True)
+            dtype = dtype + [(d[0] + suffix,) + d[1:] for suffix in
+                             ('_min', '_max') for d in dtype[1:]]
+            dtype.append(('count', int))
+        out = self._read(table, coords, dtype,
+                         None if seconds else self._storage(group))
+        if key:
+            slice_cache.put(key, out, changes,
+                            (begin - begin % seconds if seconds else begin, end))
 
         if not type(indices) == bool:
             if type(indices) == str:
@@ -259,37 +402,209 @@ class h5(object):
                 out[i] = self.doc.getNode(group, name=i)[:]
 
         if not persist:
-            self.doc.close()
+            self.close()
         return out
 
+    @instrument.timed('h5.slice_ragged', lambda out: len(out))
+    def slice_ragged(self, variables, begin=False, end=False, duration=False,
+                     timetup=False, group='/', where=None, padded=False,
+                     persist=False):
+        """
+        Read the profiles of a ragged dataset within a time window, along
+        with the given variables of their points.
+
+        Parameters
+        ----------
+        variables: list
+            a list of strings indicating the point variables to read.
+        begin, end, duration, timetup: opt
+            the time limits of the profiles, exactly as for slice()
+        group: str/group, opt
+            specify the HDF5 group where this dataset exists.
+        where: tuple, opt
+            (variable, low, high) to keep only the points whose variable is
+            from low to high, e.g. a height range. The other variables are
+            only read for these points.
+        padded: bool, opt
+            return the padded view of the result, see RaggedSlice.padded
+
+        Returns
+        -------
+        out: RaggedSlice
+            the profile times and point counts, and the points of every
+            profile one after another
+        """
+        self.openr()
+        if self.pending and not self.shared:
+            self._merge_all()
+        table = self.doc.getNode(group).data
+        points = self.doc.getNode(group, name='points')
+        begin, end = self._window(group, begin, end, duration, timetup)
+        coords = self._coords(table, group, begin, end, self._snapshot(group))
+        profiles = table.readCoordinates(coords)
+        time, start = profiles['time'], profiles['start']
+        count = profiles['count'].astype(np.int64)
+        # the rows of the points of every profile, in profile order
+        offsets = np.cumsum(count) - count
+        rows = np.repeat(start - offsets, count) + np.arange(count.sum())
+        if where is not None:
+            variable, low, high = where
+            storage = self._storage(group)
+            # read in file order, as below
+            order = np.argsort(rows, kind='mergesort')
+            value = np.empty(rows.shape[0],
+                             dtype=self._dtype(points, [variable]))
+            value[order] = self._read(points, rows[order], value.dtype,
+                                      storage)
+            value = value[variable]
+            keep = (value >= low) & (value <= high)
+            if value.ndim > 1:
+                keep = keep.all(axis=tuple(range(1, value.ndim)))
+            profile = np.repeat(np.arange(count.shape[0]), count)
+            count = np.bincount(profile[keep], minlength=count.shape[0])
+            rows = rows[keep]
+        # read the rows in file order, and put them back in profile order
+        order = np.argsort(rows, kind='mergesort')
+        out = np.empty(rows.shape[0], dtype=self._dtype(points, variables))
+        out[order] = self._read(points, rows[order], out.dtype,
+                                self._storage(group))
+        if not persist:
+            self.close()
+        out = RaggedSlice(time, count, out)
+        if padded:
+            return out.padded()
+        return out
+
+    def iter_slice(self, variables, begin=False, end=False, duration=False,
+                   timetup=False, group='/', rows=10000, window=False):
+        """
+        Read a temporal subset of various variables in blocks, so that the
+        memory used stays bounded however large the subset is.
+
+        Parameters
+        ----------
+        variables: list
+            a list of strings indicating all the variables which should be read.
+        begin, end, duration, timetup: opt
+            the time limits of the slice, exactly as for slice()
+        group: str/group, opt
+            specify the HDF5 group where this dataset exists.
+        rows: int, opt
+            the (maximum) number of rows in each block
+        window: int, opt
+            if given, blocks are instead fixed windows of this many seconds,
+            starting at begin. Windows without any data are skipped.
+
+        Yields
+        ------
+        out: numpy structured array
+            the time and variables of each block, as they would be in the
+            output of slice()
+
+        Note
+        ----
+        The rows seen are fixed when iteration begins, rows appended after
+        that are not read. The file is only open while a block is read.
+
+        See Also
+        --------
+        slice : read a subset all at once.
+        iter_dump : read a single variable in blocks.
+        """
+        self.openr()
+        if self.pending and not self.shared:
+            self._merge_all()
+        table = self.doc.getNode(group).data
+        begin, end = self._window(group, begin, end, duration, timetup)
+        dtype = self._dtype(table, variables)
+        storage = self._storage(group)
+        stop = self._snapshot(group)
+        if stop is None:
+            stop = table.nrows
+        sort = self._extent(group)['sorted']
+        self.close()
+        if window:
+            low = begin
+            while low <= end:
+                high = low + window
+                self.openr()
+                table = self.doc.getNode(group).data
+                coords = table.getWhereList('(time >= ' + str(low) + ') & '
+                    + ('(time < ' + str(high) if high <= end else
+                       '(time <= ' + str(end)) + ')', sort=True, stop=stop)
+                out = self._read(table, coords, dtype, storage)
+                self.close()
+                if out.shape[0]:
+                    yield out
+                low = high
+            return
+        if sort:
+            # rows are in time order, so only the rows of the window are read
+            self.openr()
+            table = self.doc.getNode(group).data
+            start = self._search(table, begin, 0, stop)
+            stop = self._search(table, end, start, stop, True)
+            self.close()
+        else:
+            start = 0
+        cond = '(time >= ' + str(begin) + ') & (time <= ' + str(end) + ')'
+        for first in range(start, stop, rows):
+            last = min(first + rows, stop)
+            self.openr()
+            table = self.doc.getNode(group).data
+            if sort:
+                coords = np.arange(first, last)
+            else:
+                coords = table.getWhereList(cond, sort=True, start=first,
+                                            stop=last)
+            out = self._read(table, coords, dtype, storage)
+            self.close()
+            if out.shape[0]:
+                yield out
+
     def end(self, group='/', persist=False):
         '''
             Return the maximum time in the file as would be used if 
             duration were engaged
         '''
-        if not self.doc or not self.doc.isopen:
-            self.doc, self.lock = h5openr(self.filename)
-        'Determine specified time limits'
-        table = self.doc.getNode(group).data
-        max = np.max([r['time'] for r in table[-100:]])
+        return self.extent(group, persist)['max_time']
+
+    def start(self, group='/', persist=False):
+        '''
+            Return the minimum time in the file
+        '''
+        return self.extent(group, persist)['min_time']
+
+    def extent(self, group='/', persist=False):
+        '''
+        Return the time extent of the dataset, as kept in the group
+        attributes, without reading any of the data.
+
+        Returns
+        -------
+        out: dict
+            'min_time', 'max_time', 'row_count' and 'sorted', which is True
+            while rows have been appended in time order. min_time and
+            max_time are 0 for an empty dataset.
+        '''
+        self.openr()
+        out = self._extent(group)
         if not persist:
-            self.doc.close()
-        return max
+            self.close()
+        return dict(out)
 
     def direct_r(self, group='/'):
         '''
             return direct access to the table with read-only access
         '''
-        if not self.doc or not self.doc.isopen:
-            self.doc, self.lock = h5openr(self.filename)
+        self.openr()
         return self.doc.getNode(group).data
 
     def direct_a(self, group='/'):
         '''
         directly access the data table with append access
         '''
-        if not self.doc or not self.doc.isopen:
-            self.doc, self.lock = h5opena(self.filename)
+        self.opena()
         return self.doc.getNode(group).data
 
     def get_index(self, index, group='/'):
@@ -303,8 +618,7 @@ class h5(object):
         group: str/group, opt
             string representation of the group where the indices are read from.
         """
-        if not self.doc or not self.doc.isopen:
-            self.doc, self.lock = h5openr(self.filename)
+        self.openr()
         return self.doc.getNode(group, name=index)[0]
         # take the first value ([0]) because indices are time invariant in that
         # dimension
@@ -313,8 +627,7 @@ class h5(object):
         '''
         A simple operation to print the file information to the terminal
         '''
-        if not self.doc or not self.doc.isopen:
-            self.doc, self.lock = h5openr(self.filename)
+        self.openr()
         print self.doc
         self.close()
 
@@ -332,8 +645,7 @@ class h5(object):
         
         """
         # simply stick the values of indices into their places
-        if not self.doc or not self.doc.isopen:
-            self.doc, self.lock = h5opena(self.filename)
+        self.opena()
 
         for i in indices:
             self.doc.getNode(group, name=i)[:] = indices[i]  # that is all!
@@ -341,15 +653,13 @@ class h5(object):
         self.close()
 
 
+    @instrument.timed('h5.append')
     def append(self, time, persist=False, group='/',
                filter=lambda x, y, z: True, **data):
         """
         Adds a single entry (row) for multiple variables as well as updates 
         the metadata attributes for the referred group. Appends only one row at
-        a time.
-        
-        FIXME - this ought to be updated to allow multiple rows to 
-        simultaneously be added!
+        a time, see append_many to add multiple rows simultaneously.
         
         
         Parameters
@@ -382,56 +692,296 @@ class h5(object):
         
         """
 
-        if not self.doc or not self.doc.isopen:
-            self.doc, self.lock = h5opena(self.filename)
+        self.opena()
 
         if not filter(self.doc, time, data):
             'Then the append does not pass their test, and should end'
             return False
+        if self.dedupe and not self._new_times(group, [time])[0]:
+            # the time is already in the dataset
+            if not persist:
+                self.close()
+            return False
+        if self.sort_buffer:
+            data = dict([(k, [data[k]]) for k in data])
+            return self.append_many([time], persist, group, **data) == 1
         'Grab the table\'s row operator.'
         row = self.doc.getNode(group).data.row
         'create a tuple from the given data for the given variables'
 
+        storage = self._storage(group)
         row['time'] = time
         for v in data:
             'Naturally, this will fail if the data is not the right shape!'
-            row[v] = data[v]
+            row[v] = quantize(data[v], storage[v]) if v in storage else data[v]
         'Or this might be where it fails'
         row.append()
-
+        self._grow_extent(group, [time])
 
         if not persist:
-            self.doc.close()
+            self.close()
         return True
 
-    def flush(self, group='/'):
+    @instrument.timed('h5.append_many', lambda count: count)
+    def append_many(self, times, persist=False, group='/',
+                    filter=lambda x, y, z: True, **data):
+        """
+        Adds many entries (rows) at once, writing them with a single table
+        append rather than one row at a time.
+
+        Parameters
+        ----------
+        times: array or structured array
+            Unix timestamps of the entries, or a structured array with a
+            'time' field and a field for each variable to append.
+        persist: bool
+            set to true for the file to be left open between append rounds
+        group: str,group Object
+            textual or objective reference to the group branch where the 
+            variable array is located
+        filter: function, opt
+            A method which will be passed the document, the times and the
+            data, just as the append filter, but with arrays for the whole
+            batch. It should return a single bool for the whole batch, or a
+            bool array marking the rows which are valid insertions.
+        **data: 
+            keyword arguments of variable=values, where values has one
+            entry per time
+    
+        Returns
+        -------
+        count: int
+            the number of rows appended
+
+        Note
+        ----
+        As with append, variables which are not given are filled with their
+        default value. In the dedupe mode, rows with a time already in the
+        dataset, or repeated in times, are left out (the first is kept).
+        """
+        times = np.asarray(times)
+        if times.dtype.names:
+            # split the structured array into times and variables
+            data = dict([(v, times[v]) for v in times.dtype.names
+                         if v != 'time'])
+            times = times['time']
+
+        self.opena()
+
+        mask = filter(self.doc, times, data)
+        if np.ndim(mask) == 0 and mask:
+            # a single bool (or numpy bool) for the whole batch
+            mask = slice(None)
+        elif np.ndim(mask) == 0:
+            'Then the append does not pass their test, and should end'
+            if not persist:
+                self.close()
+            return 0
+        else:
+            mask = np.asarray(mask, dtype=bool)
+        if self.dedupe:
+            new = self._new_times(group, times)
+            mask = new if type(mask) == slice else mask & new
+
+        table = self.doc.getNode(group).data
+        rows = np.empty(times.shape[0], dtype=table.dtype)
+        for v in table.colnames:
+            rows[v] = table.coldflts[v]
+        storage = self._storage(group)
+        rows['time'] = times
+        for v in data:
+            'Naturally, this will fail if the data is not the right shape!'
+            rows[v] = quantize(data[v], storage[v]) if v in storage else data[v]
+        rows = rows[mask]
+        if self.sort_buffer:
+            self._buffer(group, rows)
+        else:
+            table.append(rows)
+            self._grow_extent(group, rows['time'])
+
+        if not persist:
+            self.close()
+        return rows.shape[0]
+
+    @instrument.timed('h5.append_profiles', lambda count: count)
+    def append_profiles(self, times, counts, persist=False, group='/',
+                        point_times=None, **points):
+        """
+        Append profiles with varying numbers of points to a ragged dataset.
+
+        Parameters
+        ----------
+        times: array
+            Unix timestamps of the profiles
+        counts: array
+            the number of points in each profile
+        persist: bool
+            set to true for the file to be left open between append rounds
+        group: str,group Object
+            the group of the (ragged) dataset
+        point_times: array, opt
+            Unix timestamps of every point, by default the profile time
+        **points:
+            keyword arguments of variable=values, where values are the points
+            of every profile, one after another (sum(counts) entries)
+
+        Returns
+        -------
+        count: int
+            the number of profiles appended
+
+        Note
+        ----
+        In the dedupe mode, profiles whose time is already in the dataset are
+        left out, along with their points.
+        """
+        times = np.asarray(times)
+        counts = np.asarray(counts, dtype=np.int64)
+        if point_times is None:
+            point_times = np.repeat(times, counts)
+        self.opena()
+        table = self.doc.getNode(group).data
+        ptable = self.doc.getNode(group, name='points')
+        storage = self._storage(group)
+        if self.dedupe:
+            new = self._new_times(group, times)
+            keep = np.repeat(new, counts)
+            times, counts = times[new], counts[new]
+            point_times = np.asarray(point_times)[keep]
+            points = dict([(k, np.asarray(points[k])[keep]) for k in points])
+        rows = np.empty(counts.sum(), dtype=ptable.dtype)
+        for v in ptable.colnames:
+            rows[v] = ptable.coldflts[v]
+        rows['time'] = point_times
+        for v in points:
+            rows[v] = quantize(points[v], storage[v]) if v in storage else points[v]
+        profiles = np.empty(times.shape[0], dtype=table.dtype)
+        profiles['time'] = times
+        profiles['start'] = ptable.nrows + np.cumsum(counts) - counts
+        profiles['count'] = counts
+        ptable.append(rows)
+        if self.sort_buffer:
+            # each profile knows where its points are, so the profiles may be
+            # reordered by the buffer
+            self._buffer(group, profiles)
+        else:
+            table.append(profiles)
+            self._grow_extent(group, times)
+
+        if not persist:
+            self.close()
+        return times.shape[0]
+
+    @instrument.timed('h5.flush')
+    def flush(self, group='/', persist=False):
         '''
         Flush the table 'data' from the group identified
+
+        In the shared mode readers are excluded while the data is written,
+        and with persist the writer keeps the file open afterwards.
         '''
-        if not self.doc or not self.doc.isopen:
-            self.doc, self.lock = h5opena(self.filename)
+        self.opena()
+        self._hold_data()
+        self._merge_all()
         self.doc.getNode(group).data.flush()
+        self._update_levels()
+        self._save_extents()
+        if persist:
+            self.doc.flush()
+            if self.shared:
+                self.lock.release_data()
+            return
         self.close()
 
+    @instrument.timed('h5.index')
     def index(self, group='/'):
         '''
         Flush the table 'data' from the group identified
         '''
-        if not self.doc or not self.doc.isopen:
-            self.doc, self.lock = h5opena(self.filename)
-        self.doc.getNode(group).data.reIndex()
+        self.opena()
+        table = self.doc.getNode(group).data
+        table.reIndex()
+        # merges of a sort_buffer turn automatic indexing off
+        table.autoIndex = True
         self.close()
 
     def dirty_index(self, group='/'):
         '''
         Flush the table 'data' from the group identified
         '''
-        if not self.doc or not self.doc.isopen:
-            self.doc, self.lock = h5opena(self.filename)
-        self.doc.getNode(group).data.reIndexDirty()
+        self.opena()
+        table = self.doc.getNode(group).data
+        table.reIndexDirty()
+        table.autoIndex = True
         self.close()
 
 
+    def repack(self, group='/', block=100000):
+        '''
+        Rewrite the file with the rows of a group sorted by time, for tables
+        which were appended to out of order. Other groups, the aggregate
+        levels and the indices are copied as they are, and the file is
+        compacted as a side effect.
+
+        This works on a copy of the file, which replaces it when complete,
+        so no other process should be using the file meanwhile.
+
+        Parameters
+        ----------
+        group: str, opt
+            the group whose data table is sorted
+        block: int, opt
+            the number of rows copied at a time
+
+        Returns
+        -------
+        count: int
+            the number of rows sorted
+        '''
+        # write out anything pending first
+        self.close()
+        self.opena()
+        self._hold_data()
+        count = 0
+        tmp = self.filename + '.repack'
+        new = tables.openFile(tmp, 'w')
+        self.doc.root._v_attrs._f_copy(new.root)
+        for node in self.doc.walkNodes('/'):
+            if node is self.doc.root:
+                continue
+            parent = new.getNode(node._v_parent._v_pathname)
+            if isinstance(node, tables.Group):
+                copy = new.createGroup(parent, node._v_name)
+                node._v_attrs._f_copy(copy)
+            elif node._v_name == 'data' and node._v_parent is self.doc.getNode(group):
+                order = np.argsort(node.col('time'), kind='mergesort')
+                count = order.shape[0]
+                table = new.createTable(parent, 'data', node.description,
+                                        filters=node.filters,
+                                        chunkshape=node.chunkshape,
+                                        expectedrows=node.nrows)
+                for first in range(0, order.shape[0], block):
+                    table.append(node.readCoordinates(order[first:first + block]))
+                table.cols.time.createCSIndex(filters=node.filters)
+                table.autoIndex = True
+            else:
+                node.copy(parent, propindexes=True)
+        new.close()
+        ext = dict(self._extent(group))
+        self.doc.close()
+        os.rename(tmp, self.filename)
+        self._release_lock()
+        read_pool.discard(self.filename)
+        # the rows of every slice may be in a new order
+        ext['sorted'] = True
+        self.opena()
+        self.extents[group] = ext
+        self.touched[group] = [ext['min_time'], ext['max_time']]
+        slice_cache.invalidate(self.filename, group, ext['min_time'],
+                               ext['max_time'])
+        self.close()
+        return count
+
     def dump(self, variable, group='/'):
         """
         A method to quickly output the entire contents of any specific variable/index
@@ -440,7 +990,8 @@ class h5(object):
         Warning
         -------
         This does not currently make any checks for dataset size, so if you dump too large
-        a dataset, a significant amount of memory can be used accidentally
+        a dataset, a significant amount of memory can be used accidentally, use
+        iter_dump() to read large datasets in blocks instead.
             
         Parameters
         ----------
@@ -449,17 +1000,73 @@ class h5(object):
         group: str/group, opt
             The group the dataset is stored in.
         """
-        if not self.doc or not self.doc.isopen:
-            self.doc, self.lock = h5openr(self.filename)
-        indices = self.doc.getNodeAttr(group, 'indices')
+        self.openr()
+        if self.pending and not self.shared:
+            self._merge_all()
+        try:
+            indices = self.doc.getNodeAttr(group, 'indices')
+        except AttributeError:
+            # the dataset was created without indices
+            indices = []
         if variable in indices:
             out = self.doc.getNode(group, name=variable)[:]
         else:
             table = self.doc.getNode(group, name='data')
-            out = table.col(variable)[:]
+            out = table.read(0, self._snapshot(group), field=variable)
+            storage = self._storage(group)
+            if variable in storage:
+                out = dequantize(out, storage[variable])
         self.close()
         return out
 
+    def iter_dump(self, variable, group='/', rows=10000):
+        """
+        Output the entire contents of any specific variable/index array in
+        blocks of rows, so that the memory used stays bounded.
+
+        Parameters
+        ----------
+        variable: str
+            The variable or index array to be output.
+        group: str/group, opt
+            The group the dataset is stored in.
+        rows: int, opt
+            the (maximum) number of rows in each block
+
+        Yields
+        ------
+        out: numpy array
+            consecutive blocks of what dump() would return
+        """
+        self.openr()
+        if self.pending and not self.shared:
+            self._merge_all()
+        try:
+            indices = self.doc.getNodeAttr(group, 'indices')
+        except AttributeError:
+            # the dataset was created without indices
+            indices = []
+        if variable in indices:
+            stop = self.doc.getNode(group, name=variable).shape[0]
+        else:
+            stop = self._snapshot(group)
+            if stop is None:
+                stop = self.doc.getNode(group, name='data').nrows
+        storage = self._storage(group)
+        self.close()
+        for first in range(0, stop, rows):
+            last = min(first + rows, stop)
+            self.openr()
+            if variable in indices:
+                out = self.doc.getNode(group, name=variable)[first:last]
+            else:
+                table = self.doc.getNode(group, name='data')
+                out = table.read(first, last, field=variable)
+                if variable in storage:
+                    out = dequantize(out, storage[variable])
+            self.close()
+            yield out
+
     # Open and close methods, extending on the one written below, allows
     # simple open/close checks to be performed
     def opena(self):
@@ -467,15 +1074,440 @@ class h5(object):
         use the opena method after checking if the file already exists
         '''
         if not self.doc or not self.doc.isopen:
-            self.doc, self.fhandle, self.openSuccess, self.locktime = h5opena(self.filename)
+            if self.shared:
+                self.doc, self.lock = h5open_shared(self.filename)
+            else:
+                self.doc, self.lock = h5opena(self.filename)
 
     def openr(self):
         '''
-        open the file for reading, which should not require a lock?
+        open the file for reading, which does not require a lock. The handle
+        is taken from the process wide read pool, and is not closed by close()
+
+        In the shared mode a shared lock is held until close(), so that a
+        writer cannot write while the file is being read.
         '''
         if not self.doc or not self.doc.isopen:
-            self.doc, self.fhandle, self.openSuccess, self.locktime = h5opena(self.filename)
+            self.lock = None
+            if self.shared:
+                # lock before taking the handle, so that it sees the file
+                # as the last flush left it
+                self.lock = shared_lock(self.filename)
+                self.locktime = self.lock.acquire_read()
+            self.doc = read_pool.get(self.filename)
+            self.pooled = True
+
+    def _window(self, group, begin, end, duration, timetup):
+        '''
+        Determine the begin and end times of a slice from the ways they may
+        be given
+        '''
+        if timetup:
+            begin = timetup[0]
+            end = timetup[1]
+        elif duration and not end and not begin:
+            end = self.end(group, True)
+            begin = end - duration
+        elif duration and begin:
+            end = begin + duration
+        elif duration and end:
+            begin = end - duration
+        elif not duration and not begin and not end:
+            # No indicator of begin/end was given
+            raise Exception('You must specify a time tuple (timetup), '\
+                            + 'begin/end'\
+                            + ' or a duration in order to slice. Use dump() so see'\
+                            + ' an entire dataset')
+        return begin, end
+
+    def _dtype(self, table, variables):
+        '''
+        The dtype of a slice of the given variables
+        '''
+        'We are going to create a dtype structured array string'
+        dtype = [('time', float)]
+        if type(variables) == str:
+            'Only one variable is requested, which is always given a length'
+            dtype.append((variables, 'f4',
+                          (table.coldtypes[variables].shape or (1,))[:1]))
+        else:
+            for var in variables:
+                'determine variable shape'
+                shp = table.coldtypes[var].shape
+                dtype.append((var, 'f4', shp) if shp else (var, 'f4'))
+        return dtype
+
+    def _read(self, table, coords, dtype, storage=None):
+        '''
+        Read the (sorted) row coordinates of a table into a structured array,
+        converting quantized variables back to floats
+        '''
+        storage = storage or {}
+        out = np.empty(coords.shape[0], dtype=dtype)
+        if not coords.shape[0]:
+            return out
+        # every chunk is decompressed once, for all of the variables
+        contiguous = coords[-1] + 1 - coords[0] == coords.shape[0]
+        for first in range(0, coords.shape[0], READ_ROWS):
+            block = coords[first:first + READ_ROWS]
+            if contiguous:
+                'then we can just read the whole range of the rows'
+                rows = table.read(block[0], block[-1] + 1)
+            else:
+                rows = table.readCoordinates(block)
+            part = out[first:first + block.shape[0]]
+            for v in out.dtype.names:
+                col = rows[v]
+                if v in storage:
+                    col = dequantize(col, storage[v])
+                part[v] = col.reshape(part[v].shape)
+        return out
+
+    def _search(self, table, time, lo, hi, right=False):
+        '''
+        Search the time column of a time sorted table, between rows lo and
+        hi, for the first row after (right) or at time.
+
+        Every probe reads a whole chunk, so the position is interpolated from
+        the times either side of it, which takes a few probes for regularly
+        spaced obs. A bisection follows any probe which did not halve the
+        search, so irregular times take at most twice as many as a binary
+        search.
+        '''
+        # the times of rows lo - 1 and hi, once read
+        tlo = thi = None
+        bisect = False
+        while lo < hi:
+            width = hi - lo
+            if tlo is None:
+                mid = lo
+            elif thi is None:
+                mid = hi - 1
+            elif bisect or thi <= tlo:
+                mid = (lo + hi) // 2
+            else:
+                mid = lo - 1 + int(np.ceil((time - tlo) * (width + 1.) /
+                                           (thi - tlo)))
+                mid = min(max(mid, lo), hi - 1)
+            t = table.read(mid, mid + 1, field='time')[0]
+            if t < time or (right and t == time):
+                lo, tlo = mid + 1, t
+            else:
+                hi, thi = mid, t
+            bisect = not bisect and hi - lo > width // 2
+        return lo
+
+    def _coords(self, table, group, begin, end=None, stop=None):
+        '''
+        The sorted row coordinates of the rows of a table from begin to end
+        (inclusive), among the first stop rows. The time index is used, or a
+        search of the time column if the table is sorted and its index is
+        dirty (as a sort_buffer merge leaves it).
+        '''
+        if not self._indexed(table) and self._extent(group)['sorted']:
+            if stop is None:
+                stop = table.nrows
+            start = self._search(table, begin, 0, stop)
+            if end is not None:
+                stop = self._search(table, end, start, stop, True)
+            return np.arange(start, stop)
+        cond = '(time >= ' + str(begin) + ')'
+        if end is not None:
+            cond += ' & (time <= ' + str(end) + ')'
+        return table.getWhereList(cond, sort=True, stop=stop)
+
+    def _indexed(self, table):
+        '''
+        True if the time index of a table is up to date
+        '''
+        index = table.cols.time.index
+        return index is not None and not index.dirty
+
+    def _storage(self, group):
+        '''
+        The quantized storage types of the variables of a group
+        '''
+        try:
+            return self.doc.getNodeAttr(group, 'storage')
+        except AttributeError:
+            # files created before quantized storage
+            return {}
+
+    def _buffer(self, group, rows):
+        '''
+        Add rows to the sort_buffer of a group, merging the buffer into the
+        table once it is full
+        '''
+        if not rows.shape[0]:
+            return
+        self.pending.setdefault(group, []).append(rows)
+        self.pending_rows[group] = self.pending_rows.get(group, 0) + rows.shape[0]
+        self._grow_extent(group, rows['time'], merged=True)
+        if self.pending_rows[group] >= self.sort_buffer and not self.shared:
+            self._merge(group)
+
+    def _merge_all(self):
+        '''
+        Merge the sort_buffer of every group into its table
+        '''
+        for group in self.pending.keys():
+            self._merge(group)
+
+    def _merge(self, group, block=10000):
+        '''
+        Write the sort_buffer of a group into its table in time order. Rows
+        after the end of the table are appended, otherwise the rows of the
+        table after the earliest buffered time are rewritten, from the end
+        backwards in blocks, merged with the buffered rows.
+        '''
+        rows = np.concatenate(self.pending.pop(group))
+        self.pending_rows.pop(group)
+        rows = rows[np.argsort(rows['time'], kind='mergesort')]
+        slice_cache.invalidate(self.filename, group, int(rows['time'][0]),
+                               int(rows['time'][-1]))
+        table = self.doc.getNode(group).data
+        table.flush()
+        count = table.nrows
+        if (not self._extent(group)['sorted'] or count == 0 or
+                table.read(count - 1, count, field='time')[0] <= rows['time'][0]):
+            table.append(rows)
+            return
+        # equal times stay in the order they were appended
+        start = self._search(table, rows['time'][0], 0, count, True)
+        tail = table.read(start, count, field='time')
+        order = np.argsort(np.concatenate([tail, rows['time']]),
+                           kind='mergesort')
+        # rewriting the rows makes the index dirty, rather than reindex the
+        # whole table at every flush, the table is searched while it is
+        # sorted, until index() is next run
+        table.autoIndex = False
+        # grow the table to its new length, every new row is overwritten
+        table.append(rows)
+        table.flush()
+        # the rows of the tail only move later, so writing from the end back
+        # never overwrites a row before it is read
+        for last in range(order.shape[0], 0, -block):
+            first = max(last - block, 0)
+            take = order[first:last]
+            old = take < tail.shape[0]
+            out = np.empty(take.shape[0], dtype=table.dtype)
+            if old.any():
+                keep = take[old]
+                out[old] = table.read(start + keep[0], start + keep[-1] + 1)
+            out[~old] = rows[take[~old] - tail.shape[0]]
+            table.modifyRows(start + first, start + last, rows=out)
+        table.flush()
+
+    def _hold_data(self):
+        '''
+        In the shared mode, exclude readers from the data while the writer
+        creates, flushes or closes the file. Readers only read the rows
+        counted by the extent of the last flush, so appends do not need it.
+        '''
+        if self.shared and not self.pooled:
+            self.locktime = self.lock.acquire_data()
+
+    def _release_lock(self):
+        '''
+        Release the lock of the open file, which in the shared mode is the
+        writer lock and the data lock, if held.
+        '''
+        if self.lock is None:
+            return
+        if self.shared:
+            self.lock.release_data()
+            self.lock.release_writer()
+        else:
+            try:
+                os.close(self.lock)
+            except:
+                pass
+        self.lock = None
+
+    def _snapshot(self, group):
+        '''
+        The number of rows a reader may see, which is the flushed row count
+        in the shared mode, otherwise all of the rows
+        '''
+        if self.shared and self.pooled:
+            return self._extent(group)['row_count']
+        return None
+
+    def _extent(self, group):
+        '''
+        The extent of a group, either as it is being appended to, or as read
+        from the group attributes. Files without these attributes have them
+        computed from the time column.
+        '''
+        if group in self.extents:
+            return self.extents[group]
+        try:
+            return dict([(k, self.doc.getNodeAttr(group, k))
+                         for k in ('min_time', 'max_time', 'row_count',
+                                   'sorted')])
+        except AttributeError:
+            pass
+        t = self.doc.getNode(group).data.col('time')
+        if t.shape[0] == 0:
+            return {'min_time':0, 'max_time':0, 'row_count':0, 'sorted':True}
+        return {'min_time':int(t.min()), 'max_time':int(t.max()),
+                'row_count':t.shape[0], 'sorted':bool((np.diff(t) >= 0).all())}
+
+    def _grow_extent(self, group, times, merged=False):
+        '''
+        Update the extent of a group with appended times, which are merged
+        into time order (rather than appended) with merged
+        '''
+        if not len(times):
+            return
+        ext = dict(self._extent(group))
+        times = np.asarray(times)
+        first, low, high = int(times[0]), int(times.min()), int(times.max())
+        if ext['row_count'] == 0:
+            ext['min_time'], ext['max_time'] = low, high
+        elif not merged:
+            ext['sorted'] = bool(ext['sorted'] and first >= ext['max_time'])
+        if ext['row_count']:
+            ext['min_time'] = min(ext['min_time'], low)
+            ext['max_time'] = max(ext['max_time'], high)
+        if not merged:
+            ext['sorted'] = bool(ext['sorted'] and (np.diff(times) >= 0).all())
+        ext['row_count'] += times.shape[0]
+        self.extents[group] = ext
+        touched = self.touched.get(group, [low, high])
+        self.touched[group] = [min(low, touched[0]), max(high, touched[1])]
+        slice_cache.invalidate(self.filename, group, low, high)
+        if self._levels(group):
+            dirty = self.dirty_levels.setdefault(group, {})
+            for seconds in self._levels(group):
+                dirty.setdefault(seconds, set()).update(
+                    np.unique(times - times % seconds).tolist())
+        if group in self.times:
+            # kept aside in a small sorted array, so that single appends do
+            # not copy all of the times
+            known, recent = self.times[group][:2]
+            times = np.sort(times.astype(known.dtype))
+            recent = np.insert(recent, recent.searchsorted(times), times)
+            if recent.shape[0] > DEDUPE_BUFFER:
+                known = np.insert(known, known.searchsorted(recent), recent)
+                recent = recent[:0]
+            self.times[group] = (known, recent, ext['row_count'])
+
+    def _new_times(self, group, times):
+        '''
+        For the dedupe mode, a bool array marking which of the times are not
+        yet in the group, nor earlier in times. The sorted times of the group
+        are read once, and again only if another writer changed its row count.
+        '''
+        count = self._extent(group)['row_count']
+        if group not in self.times or self.times[group][2] != count:
+            known = self.doc.getNode(group).data.read(field='time')
+            known.sort()
+            self.times[group] = (known, known[:0], count)
+        known = self.times[group][0]
+        times = np.asarray(times).astype(known.dtype)
+        new = np.zeros(times.shape[0], dtype=bool)
+        # only the first of any repeated time
+        new[np.unique(times, return_index=True)[1]] = True
+        for known in self.times[group][:2]:
+            if known.shape[0]:
+                last = known.shape[0] - 1
+                found = known[known.searchsorted(times).clip(0, last)]
+                new &= found != times
+        return new
+
+    def _levels(self, group):
+        '''
+        The aggregate level bin lengths (seconds) kept for a group
+        '''
+        if group not in self.levels:
+            try:
+                self.levels[group] = sorted(self.doc.getNodeAttr(group,
+                                                                 'levels'))
+            except AttributeError:
+                self.levels[group] = []
+        return self.levels[group]
+
+    def _pick_level(self, group, begin, end, resolution, max_points, count):
+        '''
+        Choose the aggregate level a slice is read from, or None to read
+        the data, given the number of data rows (count) in the window
+        '''
+        levels = self._levels(group)
+        if not levels:
+            return None
+        if resolution:
+            usable = [s for s in levels if s <= resolution]
+            return usable[-1] if usable else None
+        if max_points and count > max_points:
+            for seconds in levels:
+                if (end - begin) / seconds + 1 <= max_points:
+                    return seconds
+            return levels[-1]
+        return None
+
+    def _update_levels(self):
+        '''
+        Recompute the aggregate level bins which were appended to, reading
+        only the data rows of those bins, and put them in place of the old
+        bins in each (time sorted) level table.
+        '''
+        for group in self.dirty_levels:
+            node = self.doc.getNode(group)
+            node.data.flush()
+            storage = self._storage(group)
+            for seconds, bins in self.dirty_levels[group].items():
+                level = self.doc.getNode(group, name='level_' + str(seconds))
+                bins = np.array(sorted(bins))
+                # runs of consecutive bins are read at once
+                breaks = np.flatnonzero(np.diff(bins) != seconds) + 1
+                out = []
+                for run in np.split(bins, breaks):
+                    rows = node.data.readCoordinates(self._coords(
+                        node.data, group, run[0], run[-1] + seconds - 1))
+                    out.append(aggregate(rows, seconds, level.dtype, storage))
+                out = np.concatenate(out)
+                # the bins after the first one recomputed are rewritten, which
+                # is only the last few unless older times were appended
+                keep = level.getWhereList('time < ' + str(bins[0])).shape[0]
+                tail = level.read(keep, level.nrows)
+                tail = tail[~np.in1d(tail['time'], out['time'])]
+                out = np.concatenate([tail, out])
+                out = out[np.argsort(out['time'], kind='mergesort')]
+                if keep < level.nrows:
+                    level.removeRows(keep, level.nrows)
+                level.append(out)
+                level.flush()
+        self.dirty_levels = {}
+
+    def _save_extents(self):
+        '''
+        Write the extents of the groups appended to into their attributes
+        '''
+        for group in self.extents:
+            for k in self.extents[group]:
+                self.doc.setNodeAttr(group, k, self.extents[group][k])
+        self.extents = {}
+        for group in self.touched:
+            # log the time range written, so slice caches of other processes
+            # know which of their results have changed
+            changes = self._changes(group)
+            last = changes[-1, 0] if changes.shape[0] else 0
+            changes = np.vstack([changes, [[last + 1] + self.touched[group]]])
+            self.doc.setNodeAttr(group, 'changes', changes[-CHANGE_LOG:])
+        self.touched = {}
 
+    def _changes(self, group):
+        '''
+        The log of (change number, min time, max time) of the latest writes
+        to a group, as an array
+        '''
+        try:
+            return self.doc.getNodeAttr(group, 'changes')
+        except AttributeError:
+            return np.zeros((0, 3), dtype=np.int64)
+
+    @instrument.timed('h5.close')
     def close(self):
         '''
         close a file and test for all errors
@@ -484,6 +1516,23 @@ class h5(object):
             self.table.flush()
         except:
                 pass
+        if self.pooled:
+            # leave the handle open in the pool for the next reader
+            self.doc = NullDoc()
+            self.pooled = False
+            if self.lock is not None:
+                self.lock.release_read()
+            self.lock = None
+            return
+        if self.shared and self.lock and self.doc and self.doc.isopen:
+            # the remaining data is written out as the file closes
+            self._hold_data()
+        if self.pending and self.doc and self.doc.isopen:
+            self._merge_all()
+        if self.dirty_levels and self.doc and self.doc.isopen:
+            self._update_levels()
+        if self.extents and self.doc and self.doc.isopen:
+            self._save_extents()
         try:
                 self.doc.close()
         except:
@@ -492,6 +1541,185 @@ class h5(object):
                 os.close(self.fhandle)
         except:
                 pass
+        self._release_lock()
+
+
+def storage_filters(codec='zlib', complevel=6, shuffle=True):
+    '''
+    Create the compression filters for the arguments of h5.create
+
+    Parameters
+    ----------
+    codec: str
+        the compression library, optionally with a blosc compressor, e.g.
+        'blosc:lz4', or None/'none' for no compression
+    complevel: int
+        the compression level, 0-9
+    shuffle: bool or str
+        True/'byte' for the byte shuffle filter, 'bit' for bit shuffle, which
+        needs a blosc codec and a PyTables build which supports it
+
+    Returns
+    -------
+    filters: tables.Filters
+    '''
+    if not codec or codec == 'none':
+        return tables.Filters(complevel=0)
+    try:
+        version = tables.whichLibVersion(codec.split(':')[0])
+    except ValueError:
+        version = None
+    if version is None:
+        raise ValueError('compression library ' + codec + ' is not available')
+    if ':' in codec:
+        # blosc compressors are only known to newer builds of PyTables
+        compressors = getattr(tables, 'blosc_compressor_list', lambda: [])()
+        if codec.split(':', 1)[1] not in compressors:
+            raise ValueError('blosc compressor ' + codec + ' is not available')
+    if shuffle == 'bit':
+        # as is bitshuffle, which is a blosc filter
+        if not codec.startswith('blosc'):
+            raise ValueError('bit shuffle needs a blosc codec, not ' + codec)
+        try:
+            return tables.Filters(complevel=complevel, complib=codec,
+                                  shuffle=False, bitshuffle=True)
+        except TypeError:
+            raise ValueError('bit shuffle is not available in PyTables '
+                             + tables.__version__)
+    return tables.Filters(complevel=complevel, complib=codec,
+                          shuffle=bool(shuffle))
+
+
+def storage_spec(spec):
+    '''
+    Normalize a quantized storage type, as given to h5.create, into a list
+    of [type, scale, offset]
+    '''
+    if isinstance(spec, basestring):
+        spec = (spec,)
+    if spec[0] not in QUANTIZED:
+        raise ValueError('storage type must be one of ' + str(QUANTIZED.keys()))
+    if spec[0] == 'float16' and len(spec) > 1:
+        raise ValueError('float16 storage takes no scale or offset')
+    scale = float(spec[1]) if len(spec) > 1 else QUANTIZED[spec[0]]
+    offset = float(spec[2]) if len(spec) > 2 else 0.
+    return [str(spec[0]), scale, offset]
+
+
+def quantize(values, spec):
+    '''
+    Convert float values to their quantized storage type. NaN and -9999.
+    become the missing value, and int16 values are clipped to their range.
+    '''
+    x = np.asarray(values, dtype=np.float64)
+    bad = np.isnan(x) | (x == -9999.)
+    if spec[0] == 'float16':
+        return np.where(bad, np.nan, x).astype(np.float16)
+    with np.errstate(invalid='ignore'):
+        q = np.clip(np.round((x - spec[2]) / spec[1]), -32767, 32767)
+    q[bad] = MISSING_INT16
+    return q.astype(np.int16)
+
+
+def dequantize(values, spec):
+    '''
+    Convert quantized values back to float32, missing values become NaN
+    '''
+    values = np.asarray(values)
+    if spec[0] == 'float16':
+        return values.astype(np.float32)
+    out = (values * spec[1] + spec[2]).astype(np.float32)
+    out[values == MISSING_INT16] = np.nan
+    return out
+
+
+def aggregate(rows, seconds, dtype, storage={}):
+    '''
+    Reduce data rows into time bins of the given length, as a structured
+    array of the level dtype: the bin start time, the row count, and the
+    mean, min and max of every variable. NaNs and the -9999. fill value are
+    left out of the statistics. Quantized variables, given by storage, are
+    converted back to floats first.
+    '''
+    bins = rows['time'] - rows['time'] % seconds
+    order = np.argsort(bins, kind='mergesort')
+    bins = bins[order]
+    starts = np.flatnonzero(np.r_[True, bins[1:] != bins[:-1]])
+    out = np.empty(starts.shape[0], dtype=dtype)
+    if not starts.shape[0]:
+        return out
+    out['time'] = bins[starts]
+    out['count'] = np.diff(np.r_[starts, bins.shape[0]])
+    for v in rows.dtype.names:
+        if v == 'time' or v not in dtype.names:
+            continue
+        if v in storage:
+            x = dequantize(rows[v][order], storage[v]).astype(np.float64)
+        else:
+            x = rows[v][order].astype(np.float64)
+        bad = np.isnan(x) | (x == -9999.)
+        x[bad] = np.nan
+        total = np.add.reduceat(np.where(bad, 0., x), starts, axis=0)
+        n = np.add.reduceat(~bad, starts, axis=0)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            out[v] = total / n
+        out[v + '_min'] = np.fmin.reduceat(x, starts, axis=0)
+        out[v + '_max'] = np.fmax.reduceat(x, starts, axis=0)
+    return out
+
+
+class RaggedSlice(object):
+    '''
+    The result of h5.slice_ragged: profiles with varying numbers of points,
+    kept compactly as the points of every profile one after another.
+
+    Attributes
+    ----------
+    time: array
+        the time of each profile
+    count: array
+        the number of points in each profile
+    offsets: array
+        the index of the first point of each profile, and (last) the number
+        of points
+    points: numpy structured array
+        the time and variables of every point
+    '''
+    def __init__(self, time, count, points):
+        self.time = time
+        self.count = count
+        self.offsets = np.concatenate([[0], np.cumsum(count)])
+        self.points = points
+
+    def __len__(self):
+        return self.time.shape[0]
+
+    def profile(self, i):
+        '''
+        The points of profile i
+        '''
+        return self.points[self.offsets[i]:self.offsets[i + 1]]
+
+    def padded(self, fill=np.nan):
+        '''
+        A padded view of the points, as a dict of (profile x point) arrays
+        as long as the longest profile, filled after the end of each profile.
+        'time' is the time of each profile, and 'point_time' that of every
+        point, and 'count' the number of points in each profile.
+        '''
+        width = self.count.max() if self.count.shape[0] else 0
+        # the (profile, point) position of every point
+        profile = np.repeat(np.arange(self.count.shape[0]), self.count)
+        point = np.arange(self.points.shape[0]) - self.offsets[profile]
+        out = {'time':self.time, 'count':self.count}
+        for v in self.points.dtype.names:
+            col = self.points[v]
+            pad = np.empty((self.count.shape[0], width) + col.shape[1:],
+                           dtype=col.dtype)
+            pad.fill(fill)
+            pad[profile, point] = col
+            out['point_time' if v == 'time' else v] = pad
+        return out
 
 
 class NullDoc(object):
@@ -508,37 +1736,189 @@ class NullDoc(object):
 def h5open_lock(fname, mode='a'):
     '''
     lock the file, open it, and deal with errors appropriately.
+
+    A missing (or empty) file is created as a new HDF5 file. Any other
+    failure to open the file is raised, so that an existing archive which
+    PyTables cannot read is never replaced by an empty one.
     '''
-    # if os.path.exists(fname):
-    f = None
-    ltime = 0
+    stime = time.time()
     try:
-        fhandle = None
-        stime = time.time()
         fhandle = os.open(fname, os.O_RDWR)
-        fcntl.lockf(fhandle, fcntl.LOCK_EX)
-        ltime = time.time() - stime
+    except OSError:
+        if os.path.exists(fname):
+            raise
+        # no such file, so create one
+        os.close(os.open(fname, os.O_CREAT))
+        fhandle = os.open(fname, os.O_RDWR)
+    fcntl.lockf(fhandle, fcntl.LOCK_EX)
+    ltime = record_lock_wait(time.time() - stime)
+    if mode == 'a' and os.path.getsize(fname) == 0:
+        # the new file is empty, so it must be opened as a new HDF5 file
+        mode = 'w'
+    try:
         f = tables.openFile(fname, mode)
     except:
-        # this didn't work, file probably doesn't exist.
-        if fhandle is not None:
-            os.close(fhandle)
-            fhandle = None
-    if f and fhandle:
-        # successful open and lock
-        # l.info('HDF opened: ' + fname)
-        return f, fhandle, 1, ltime
-    if fhandle is not None:
-        # then the file opened, but tables balked
-        return False, False, 0, ltime
-    else:
-        # no such file, so create one
-        fhandle = os.open(fname, os.O_CREAT)
         os.close(fhandle)
-        # if this breaks, we will ahve a small problem
-        time.sleep(.1)
-        # run this again recursively, it does not appear to hang in tests.
-        return h5open_lock(fname, mode)
+        raise
+    return f, fhandle, 1, ltime
+
+
+@instrument.timed('h5.open')
+def h5open_shared(fname, mode='a'):
+    '''
+    open the file for the writer of the shared concurrency mode.
+
+    Rather than locking the whole file, the writer holds the writer lock of
+    the SharedLock while the file is open, keeping out other writers, and
+    only takes the data lock, which readers share, while it flushes.
+
+    Returns the PyTables file and the SharedLock.
+    '''
+    read_pool.discard(fname)
+    lock = shared_lock(fname)
+    lock.acquire_writer()
+    if mode == 'a' and (not os.path.exists(fname)
+                        or os.path.getsize(fname) == 0):
+        # a new, empty file
+        mode = 'w'
+    try:
+        f = tables.openFile(fname, mode)
+    except:
+        lock.release_writer()
+        raise
+    return f, lock
+
+
+class SharedLock(object):
+    '''
+    The locks of the shared concurrency mode for one file, which are POSIX
+    record locks on a separate lock file, <fname>.lock. Byte 1 is locked by
+    the writer while it has the file open, and byte 0 (the data) by the
+    writer while it flushes, or shared by the readers while they read.
+
+    POSIX locks belong to the process, and closing any handle of a file
+    drops all of them, so there is one SharedLock per file in a process,
+    whose handle is never closed, and which counts the readers of the
+    process rather than locking for each of them. Readers in the process of
+    the writer do not wait for it.
+    '''
+    def __init__(self, fname):
+        self.fhandle = os.open(fname + '.lock', os.O_RDWR | os.O_CREAT)
+        self.pid = os.getpid()
+        self.readers = 0
+        self.writing = False
+
+    def _lockf(self, cmd, byte):
+        '''
+        lock (or unlock) a byte of the lock file, returning the time spent
+        waiting for the lock
+        '''
+        stime = time.time()
+        fcntl.lockf(self.fhandle, cmd, 1, byte)
+        if cmd != fcntl.LOCK_UN:
+            return record_lock_wait(time.time() - stime)
+        return 0.
+
+    def acquire_writer(self):
+        '''
+        keep out other writers, while the file is open
+        '''
+        return self._lockf(fcntl.LOCK_EX, 1)
+
+    def release_writer(self):
+        '''
+        let other writers open the file
+        '''
+        self._lockf(fcntl.LOCK_UN, 1)
+
+    def acquire_data(self):
+        '''
+        keep out readers, while the writer flushes
+        '''
+        if self.writing:
+            return 0.
+        self.writing = True
+        return self._lockf(fcntl.LOCK_EX, 0)
+
+    def release_data(self):
+        '''
+        let readers in again, after a flush
+        '''
+        if not self.writing:
+            return
+        self.writing = False
+        # readers of this process keep their shared lock
+        self._lockf(fcntl.LOCK_SH if self.readers else fcntl.LOCK_UN, 0)
+
+    def acquire_read(self):
+        '''
+        share the data with other readers, while reading
+        '''
+        self.readers += 1
+        if self.readers == 1 and not self.writing:
+            return self._lockf(fcntl.LOCK_SH, 0)
+        return 0.
+
+    def release_read(self):
+        '''
+        finish reading
+        '''
+        self.readers -= 1
+        if not self.readers and not self.writing:
+            self._lockf(fcntl.LOCK_UN, 0)
+
+
+def shared_lock(fname):
+    '''
+    The SharedLock of fname for this process. A forked process holds none of
+    the locks of its parent, so it starts again with the inherited handle.
+    '''
+    lock = shared_locks.get(fname)
+    if lock is None:
+        lock = shared_locks[fname] = SharedLock(fname)
+    elif lock.pid != os.getpid():
+        lock.pid, lock.readers, lock.writing = os.getpid(), 0, False
+    return lock
+
+shared_locks = {}
+
+
+def record_lock_wait(ltime):
+    '''
+    Add a lock wait time to the process wide lock_stats (and the
+    instrumentation), returning it.
+    '''
+    instrument.record('h5.lock_wait', ltime)
+    lock_stats['count'] += 1
+    lock_stats['wait'] += ltime
+    lock_stats['max'] = max(lock_stats['max'], ltime)
+    return ltime
+
+# number of locks acquired, and the total and longest time waited for them
+lock_stats = {'count':0, 'wait':0., 'max':0.}
+
+
+@instrument.timed('h5.open')
+def h5opena(fname):
+    '''
+    lock the file and open it for appending, creating it if necessary.
+
+    Returns the PyTables file and the locked os file handle, which must be
+    closed to release the lock.
+    '''
+    read_pool.discard(fname)
+    f, fhandle, success, ltime = h5open_lock(fname, 'a')
+    return f, fhandle
+
+
+@instrument.timed('h5.open')
+def h5openw(fname):
+    '''
+    lock the file and open it for writing, clearing any existing contents.
+    '''
+    read_pool.discard(fname)
+    f, fhandle, success, ltime = h5open_lock(fname, 'w')
+    return f, fhandle
 
 
 def h5close(table, doc, fhandle):
@@ -564,33 +1944,160 @@ def h5close(table, doc, fhandle):
 
 
 
+@instrument.timed('h5.open_read')
 def h5openr(fname):
     '''
-    lock the file, open it, and deal with errors appropriately.
+    open the file read-only. Readers do not lock the file, so the second
+    value returned (the lock handle of the other open methods) is None.
     '''
-    l.warning('do not use locking for read processes')
-    return False
-    # if os.path.exists(fname):
-    f = None
-    ltime = 0
-    try:
-        fhandle = None
-        stime = time.time()
-        # fhandle = os.open(fname, os.O_RDONLY)
-        # fcntl.lockf(fhandle, fcntl.LOCK_SH)
-        ltime = time.time() - stime
-        f = tables.openFile(fname, 'r')
-    except:
-        if fhandle is not None:
-            os.close(fhandle)
-            fhandle = None
-    if f and fhandle:
-        # successful open and lock
-        l.info('HDF opened: ' + fname)
-        return f, fhandle, 1, ltime
-    else:
-        # no such file, so create one
-        return None, None, 0, ltime
+    return tables.openFile(fname, 'r'), None
+
+
+class ReadPool(object):
+    '''
+    A process wide pool of open read-only handles, keyed by filename, so
+    that repeated reads of the same archives do not reopen the file.
+
+    Handles are evicted in least recently used order once more than size
+    files are open, and are reopened when the modification time or size of
+    the file has changed since it was opened. A forked process closes the
+    handles it inherited, and opens its own.
+    '''
+    def __init__(self, size=16):
+        self.size = size
+        self.handles = collections.OrderedDict()
+        self.pid = os.getpid()
+
+    def _check_fork(self):
+        '''
+        Close the handles inherited from a parent process. They are read-only,
+        so closing them here leaves the handles of the parent as they are,
+        and removes them from the open files of PyTables in this process.
+        '''
+        if self.pid != os.getpid():
+            self.pid = os.getpid()
+            self.clear()
+
+    def get(self, fname):
+        '''
+        Return an open read-only PyTables file for fname
+        '''
+        self._check_fork()
+        st = os.stat(fname)
+        stamp = (st.st_mtime, st.st_size)
+        if fname in self.handles:
+            doc, opened = self.handles.pop(fname)
+            if opened == stamp and doc.isopen:
+                self.handles[fname] = (doc, opened)
+                return doc
+            # the file has changed, so the handle may not see all the data
+            doc.close()
+        doc = h5openr(fname)[0]
+        self.handles[fname] = (doc, stamp)
+        while len(self.handles) > self.size:
+            self.handles.popitem(last=False)[1][0].close()
+        return doc
+
+    def discard(self, fname):
+        '''
+        Close and forget the handle for fname, if there is one
+        '''
+        self._check_fork()
+        if fname in self.handles:
+            self.handles.pop(fname)[0].close()
+
+    def clear(self):
+        '''
+        Close every pooled handle
+        '''
+        while self.handles:
+            self.handles.popitem()[1][0].close()
+
+read_pool = ReadPool()
+
+
+class SliceCache(object):
+    '''
+    A process wide, least recently used cache of slice results, limited to a
+    budget of bytes.
+
+    Results are dropped when this process appends to an overlapping time
+    range, and when the change log of the group, written on every flush,
+    shows that another process has. Keys include the creation id of the
+    dataset, so results of a dataset which was since created again are
+    not found.
+    '''
+    def __init__(self, budget=256 * 2 ** 20):
+        self.budget = budget
+        self.size = 0
+        self.entries = collections.OrderedDict()
+        self.stats = {'hits':0, 'misses':0, 'evictions':0, 'invalidations':0}
+
+    def get(self, key, changes):
+        '''
+        Return the cached (read-only) result for key, or None. changes is
+        the current change log of the group
+        '''
+        if key not in self.entries:
+            self.stats['misses'] += 1
+            return None
+        out, seen, window = self.entries.pop(key)
+        last = changes[-1, 0] if changes.shape[0] else 0
+        if last != seen:
+            newer = changes[changes[:, 0] > seen]
+            if (last < seen or newer[0, 0] > seen + 1 or
+                ((newer[:, 1] <= window[1]) & (newer[:, 2] >= window[0])).any()):
+                # the log was restarted, does not reach back far enough, or
+                # the data changed
+                self.size -= out.nbytes
+                self.stats['invalidations'] += 1
+                self.stats['misses'] += 1
+                return None
+        self.entries[key] = (out, last, window)
+        self.stats['hits'] += 1
+        return out
+
+    def put(self, key, out, changes, window):
+        '''
+        Cache a result, which covers the (begin, end) time window
+        '''
+        if out.nbytes > self.budget:
+            return
+        self.discard(key)
+        while self.entries and self.size + out.nbytes > self.budget:
+            self.size -= self.entries.popitem(last=False)[1][0].nbytes
+            self.stats['evictions'] += 1
+        out.flags.writeable = False
+        self.entries[key] = (out, changes[-1, 0] if changes.shape[0] else 0,
+                             window)
+        self.size += out.nbytes
+
+    def invalidate(self, filename, group, low, high):
+        '''
+        Drop the results of a file and group which overlap the times low-high
+        '''
+        for key in self.entries.keys():
+            window = self.entries[key][2]
+            if (key[0] == filename and key[1] == group and low <= window[1]
+                and high >= window[0]):
+                self.discard(key)
+                self.stats['invalidations'] += 1
+
+    def discard(self, key):
+        '''
+        Drop a single result, if it is cached
+        '''
+        if key in self.entries:
+            self.size -= self.entries.pop(key)[0].nbytes
+
+    def clear(self):
+        '''
+        Drop every cached result
+        '''
+        self.entries.clear()
+        self.size = 0
+
+slice_cache = SliceCache()
 
 '''
 Here I include an example append filter, to filter if a time already exists in the data
@@ -0,0 +1,209 @@
+'''
+Pipeline stages which move decoded observations into the muto HDF5 archive.
+
+Log files are read through the batch generators of the decoders, and every
+batch is written to the archive with a single table append, so no CSV (or
+other intermediate) copy of the data is needed.
+'''
+import numpy as np
+import tables
+import itertools
+import multiprocessing
+import logging as l
+from muto.storage.h5 import h5
+from muto.accessories.decoders.profile.logfile import iter_log
+
+# number of rows written between flushes of the archive, after which the rows
+# are visible to readers (of the shared mode, in particular)
+FLUSH_ROWS = 100000
+
+
+def ingest_log(source, archive, group='/', instrument='cl31',
+               variables=('bs', 'status'), flush=FLUSH_ROWS, **kwargs):
+    """
+    Decode a ceilometer log file and append all of its observations to an
+    archive, creating the dataset from the decoded shapes if it does not
+    exist yet.
+
+    Parameters
+    ----------
+    source: str or file
+        the log file to read, see logfile.iter_log
+    archive: str or h5
+        the HDF5 file name, or an h5 object
+    group: str, opt
+        the group the dataset resides in
+    instrument: str, opt
+        the message type, 'cl31' or 'ct12'
+    variables: list, opt
+        the decoded outputs which are saved as variables
+    flush: int, opt
+        flush the archive after every this many rows written
+    **kwargs:
+        passed on to logfile.iter_log (batch, chunk, time_format, ...)
+
+    Returns
+    -------
+    counts: dict
+        the 'found', 'decoded', 'rejected' and 'written' message counts
+    """
+    if isinstance(archive, basestring):
+        archive = h5(archive)
+    counts = kwargs.pop('counts', {})
+    counts.setdefault('written', 0)
+    unflushed = 0
+    try:
+        for times, out in iter_log(source, instrument, counts=counts,
+                                   **kwargs):
+            written = write_batch(archive, times, out, group, variables)
+            counts['written'] += written
+            unflushed += written
+            if unflushed >= flush:
+                archive.flush(group, persist=True)
+                unflushed = 0
+        if archive.doc and archive.doc.isopen:
+            archive.doc.getNode(group).data.flush()
+    finally:
+        archive.close()
+    l.info('ingested ' + str(counts['written']) + ' obs into '
+           + archive.filename)
+    return counts
+
+
+def ingest_files(sources, archive, group='/', instrument='cl31',
+                 variables=('bs', 'status'), workers=None, ordered=True,
+                 block=10000, flush=FLUSH_ROWS, **kwargs):
+    """
+    Decode many log files in parallel and write all of their observations
+    into one archive.
+
+    The files are decoded by a pool of worker processes, while this process
+    is the only writer: it opens (and locks) the archive once, and appends
+    the decoded batches in large blocks as they arrive.
+
+    Parameters
+    ----------
+    sources: list
+        the log files to read
+    archive: str or h5
+        the HDF5 file name, or an h5 object
+    group: str, opt
+        the group the dataset resides in
+    instrument: str, opt
+        the message type, 'cl31' or 'ct12'
+    variables: list, opt
+        the decoded outputs which are saved as variables
+    workers: int, opt
+        the number of decoding processes, defaults to the number of cpus.
+        With 1 worker the files are decoded in this process.
+    ordered: bool, opt
+        write the files in the order given, otherwise files are written as
+        soon as they are decoded
+    block: int, opt
+        the minimum number of rows gathered before appending to the archive
+    flush: int, opt
+        flush the archive after every this many rows written
+    **kwargs:
+        passed on to logfile.iter_log (chunk, time_format, ...)
+
+    Returns
+    -------
+    counts: dict
+        the total 'found', 'decoded', 'rejected' and 'written' message counts,
+        and 'files', a dict of the counts for every source file.
+    """
+    if isinstance(archive, basestring):
+        archive = h5(archive)
+    jobs = [(source, instrument, variables, kwargs) for source in sources]
+    pool = None
+    if workers == 1:
+        results = itertools.imap(_decode_file, jobs)
+    else:
+        pool = multiprocessing.Pool(workers)
+        if ordered:
+            results = pool.imap(_decode_file, jobs)
+        else:
+            results = pool.imap_unordered(_decode_file, jobs)
+
+    counts = {'found':0, 'decoded':0, 'rejected':0, 'written':0, 'files':{}}
+    pending = []
+    size = 0
+    unflushed = 0
+    try:
+        for source, times, out, file_counts in results:
+            counts['files'][source] = file_counts
+            for k in ('found', 'decoded', 'rejected'):
+                counts[k] += file_counts[k]
+            if not len(times):
+                continue
+            pending.append((times, out))
+            size += len(times)
+            if size >= block:
+                written = _write_pending(archive, pending, group, variables)
+                counts['written'] += written
+                unflushed += written
+                pending = []
+                size = 0
+            if unflushed >= flush:
+                archive.flush(group, persist=True)
+                unflushed = 0
+        counts['written'] += _write_pending(archive, pending, group, variables)
+        if archive.doc and archive.doc.isopen:
+            archive.doc.getNode(group).data.flush()
+    finally:
+        archive.close()
+        if pool is not None:
+            pool.terminate()
+            pool.join()
+    l.info('ingested ' + str(counts['written']) + ' obs from '
+           + str(len(sources)) + ' files into ' + archive.filename)
+    return counts
+
+
+def _decode_file(job):
+    '''
+    Worker process method, decoding a whole log file into single arrays of
+    the requested variables.
+    '''
+    source, instrument, variables, kwargs = job
+    counts = {}
+    times = []
+    out = dict([(v, []) for v in variables])
+    for t, o in iter_log(source, instrument, counts=counts, **kwargs):
+        times.append(t)
+        for v in variables:
+            out[v].append(o[v])
+    if not times:
+        return source, np.zeros(0, dtype=int), {}, counts
+    return (source, np.concatenate(times),
+            dict([(v, np.concatenate(out[v])) for v in variables]), counts)
+
+
+def _write_pending(archive, pending, group, variables):
+    '''
+    Join a list of decoded (times, out) batches, and write them at once
+    '''
+    if not pending:
+        return 0
+    times = np.concatenate([t for t, o in pending])
+    out = dict([(v, np.concatenate([o[v] for t, o in pending]))
+                for v in variables])
+    return write_batch(archive, times, out, group, variables)
+
+
+def write_batch(archive, times, out, group='/', variables=('bs', 'status')):
+    '''
+    Append a decoded batch to the archive with one table append, leaving
+    the file open for the next batch. Returns the number of rows written.
+    '''
+    if not len(times):
+        return 0
+    data = dict([(v, out[v]) for v in variables])
+    try:
+        return archive.append_many(times, persist=True, group=group, **data)
+    except tables.NoSuchNodeError:
+        # a new dataset, shaped like the decoded values
+        archive.close()
+        archive.create(group=group,
+                       **dict([(v, out[v].shape[1:]) for v in variables]))
+        return archive.append_many(times, persist=True, group=group, **data)
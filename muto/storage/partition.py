@@ -0,0 +1,291 @@
+'''
+A time partitioned archive, built from many muto HDF5 files.
+
+Data are rolled into one h5 file per day or month under a directory, and a
+small JSON manifest records the time extent and variables of every
+partition. Slices only open the partitions which overlap the requested
+window, so every file (and its index) stays small, and partitions which are
+no longer written to can be treated as read-only.
+'''
+import os
+import json
+import numpy as np
+import logging as l
+from muto.storage.h5 import h5
+
+# numpy datetime units and file name lengths of the partition periods
+PERIODS = {'day':('D', 10), 'month':('M', 7)}
+
+
+class partitioned(object):
+    '''
+    Class for interacting with a directory of time partitioned HDF5 files
+    '''
+
+    def __init__(self, directory, period='month', shared=False, dedupe=False,
+                 sort_buffer=0):
+        """
+        Open (or prepare) a partitioned archive in a directory.
+
+        Parameters
+        ----------
+        directory : str
+            the directory holding the partition files and the manifest
+        period : str, optional (default='month')
+            'day' or 'month', the length of time held in each partition. An
+            existing archive keeps the period recorded in its manifest.
+        shared : bool, optional
+            open the partitions in the shared concurrency mode of h5
+        dedupe : bool, optional
+            reject appended rows whose time is already in the archive, see h5
+        sort_buffer : int, optional
+            keep each partition sorted by merging out of order rows into it
+            through a buffer of this many rows, see h5
+        """
+        self.directory = directory
+        self.shared = shared
+        self.dedupe = dedupe
+        self.sort_buffer = sort_buffer
+        self.manifest_file = os.path.join(directory, 'manifest.json')
+        if os.path.exists(self.manifest_file):
+            self.manifest = json.load(open(self.manifest_file))
+        else:
+            if period not in PERIODS:
+                raise ValueError('period must be one of ' + str(PERIODS.keys()))
+            self.manifest = {'period':period, 'groups':{}, 'partitions':{}}
+        self.period = self.manifest['period']
+        # h5 objects of partitions left open by persistent appends
+        self.open = {}
+
+    def create(self, group='/', codec='zlib', complevel=6, shuffle=True,
+               chunkrows=None, storage=None, **variables):
+        """
+        Declare a dataset in the archive. The partition files themselves are
+        created as data are appended to them.
+
+        Parameters
+        ----------
+        group: str,opt
+            The textual representation of the group the dataset will 
+            reside in
+        codec, complevel, shuffle, chunkrows, storage: opt
+            the compression, chunking and quantized storage of every
+            partition, as given to h5.create
+        **variables:
+            name=[length,length,...] values to state the expandable 
+            variables for the dataset, as given to h5.create
+        """
+        if not os.path.isdir(self.directory):
+            os.makedirs(self.directory)
+        self.manifest['groups'][group] = dict(
+            [(k, [int(x) for x in np.atleast_1d(variables[k])]
+              if variables[k] else []) for k in variables])
+        self.manifest.setdefault('options', {})[group] = {
+            'codec':codec, 'complevel':complevel, 'shuffle':shuffle,
+            'chunkrows':chunkrows, 'storage':storage}
+        self.save_manifest()
+        return True
+
+    def append(self, time, persist=False, group='/', **data):
+        '''
+        Add a single row, see append_many
+        '''
+        data = dict([(k, [data[k]]) for k in data])
+        return self.append_many([time], persist, group, **data) == 1
+
+    def append_many(self, times, persist=False, group='/', **data):
+        """
+        Append rows to the archive, routing each one to the partition which
+        holds its time.
+
+        Parameters
+        ----------
+        times: array
+            Unix timestamps of the entries
+        persist: bool
+            leave the partition files open for further appends, they are
+            closed (and the manifest saved) by close()
+        group: str
+            the group of the dataset, which must have been declared by create
+        **data:
+            keyword arguments of variable=values, one entry per time
+
+        Returns
+        -------
+        count: int
+            the number of rows appended
+        """
+        times = np.asarray(times)
+        keys = self.partition_keys(times)
+        count = 0
+        for key in np.unique(keys):
+            rows = keys == key
+            archive = self._partition(key, group)
+            count += archive.append_many(
+                times[rows], persist=True, group=group,
+                **dict([(k, np.asarray(data[k])[rows]) for k in data]))
+            self._record(key, group, archive.extent(group, persist=True))
+        if not persist:
+            self.close()
+        return count
+
+    def slice(self, variables, begin=False, end=False, duration=False,
+              timetup=False, group='/'):
+        """
+        Read a temporal subset of variables from every partition which
+        overlaps it, see h5.slice for the arguments.
+
+        Returns
+        -------
+        out: structured array
+            the concatenated slices of the partitions, in time order.
+        """
+        self.close()
+        if timetup:
+            begin, end = timetup
+        elif duration and not end and not begin:
+            end = self.end(group)
+            begin = end - duration
+        elif duration and begin:
+            end = begin + duration
+        elif duration and end:
+            begin = end - duration
+        elif not duration and not begin and not end:
+            raise Exception('You must specify a time tuple (timetup), '\
+                            + 'begin/end or a duration in order to slice.')
+        out = []
+        for key in self.partitions(begin, end, group):
+            out.append(h5(self._file(key), shared=self.shared).slice(
+                variables, timetup=(begin, end), group=group))
+        if not out:
+            return np.zeros(0, dtype=self._dtype(variables, group))
+        return np.concatenate(out)
+
+    def partitions(self, begin=None, end=None, group='/'):
+        '''
+        The sorted keys of the partitions holding data for group which
+        overlap the begin/end window (either may be None)
+        '''
+        keys = []
+        for key in sorted(self.manifest['partitions']):
+            ext = self.manifest['partitions'][key].get(group)
+            if not ext or not ext['row_count']:
+                continue
+            if begin is not None and ext['max_time'] < begin:
+                continue
+            if end is not None and ext['min_time'] > end:
+                continue
+            keys.append(key)
+        return keys
+
+    def end(self, group='/'):
+        '''
+        Return the maximum time in the archive, from the manifest, or 0 if
+        it is empty
+        '''
+        return max([self.manifest['partitions'][k][group]['max_time']
+                    for k in self.partitions(group=group)] or [0])
+
+    def start(self, group='/'):
+        '''
+        Return the minimum time in the archive, from the manifest, or 0 if
+        it is empty
+        '''
+        return min([self.manifest['partitions'][k][group]['min_time']
+                    for k in self.partitions(group=group)] or [0])
+
+    def partition_keys(self, times):
+        '''
+        The partition key (an ISO date string, such as 2013-02 for a month)
+        of every time
+        '''
+        unit, length = PERIODS[self.period]
+        return np.asarray(times).astype('datetime64[s]').astype(
+            'datetime64[' + unit + ']').astype('S' + str(length))
+
+    def close(self):
+        '''
+        Close any partition files left open, and save the manifest
+        '''
+        if not self.open:
+            return
+        for key in self.open:
+            self.open[key].close()
+        self.open = {}
+        self.save_manifest()
+
+    def repack(self, group='/'):
+        '''
+        Sort every partition of a dataset which was appended to out of
+        order, see h5.repack. Returns the number of rows sorted.
+        '''
+        self.close()
+        count = 0
+        for key in sorted(self.manifest['partitions']):
+            ext = self.manifest['partitions'][key].get(group)
+            if ext and not ext['sorted']:
+                archive = h5(self._file(key), shared=self.shared)
+                count += archive.repack(group)
+                self._record(key, group, archive.extent(group))
+        self.save_manifest()
+        return count
+
+    def save_manifest(self):
+        '''
+        Write the manifest, replacing the old one in a single rename so that
+        readers never see a partial file
+        '''
+        tmp = self.manifest_file + '.tmp'
+        with open(tmp, 'w') as f:
+            json.dump(self.manifest, f, indent=1, sort_keys=True)
+        os.rename(tmp, self.manifest_file)
+
+    def _file(self, key):
+        return os.path.join(self.directory, key + '.h5')
+
+    def _partition(self, key, group):
+        '''
+        The open h5 object of a partition, creating the dataset if needed
+        '''
+        if key not in self.open:
+            self.open[key] = h5(self._file(key), shared=self.shared,
+                                dedupe=self.dedupe,
+                                sort_buffer=self.sort_buffer)
+        archive = self.open[key]
+        if group not in self.manifest['partitions'].get(key, {}):
+            if group not in self.manifest['groups']:
+                raise KeyError('the dataset ' + group + ' has not been created')
+            variables = dict([(k, tuple(v)) for k, v in
+                              self.manifest['groups'][group].items()])
+            options = dict([(str(k), v) for k, v in
+                            self.manifest.get('options', {}).get(group, {}).items()])
+            variables.update(options)
+            archive.opena()
+            # the manifest may have been lost before a crash
+            if group.rstrip('/') + '/data' not in archive.doc:
+                archive.create(close=False, group=group, **variables)
+                l.info('partition created: ' + self._file(key) + ' ' + group)
+            self._record(key, group, archive.extent(group, persist=True))
+            self.save_manifest()
+        return archive
+
+    def _record(self, key, group, ext):
+        '''
+        Record the extent and variables of a partition in the manifest
+        '''
+        # times are kept whole, a truncated max_time would hide its rows
+        ext = {'min_time':float(ext['min_time']),
+               'max_time':float(ext['max_time']),
+               'row_count':int(ext['row_count']), 'sorted':bool(ext['sorted'])}
+        ext['variables'] = sorted(self.manifest['groups'][group])
+        self.manifest['partitions'].setdefault(key, {})[group] = ext
+
+    def _dtype(self, variables, group):
+        '''
+        The dtype slice gives these variables, for an empty result
+        '''
+        spec = self.manifest['groups'][group]
+        if isinstance(variables, str):
+            return [('time', float), (variables, 'f4', tuple(spec[variables][:1]) or (1,))]
+        return [('time', float)] + [(v, 'f4', tuple(spec[v])) if spec[v]
+                                     else (v, 'f4') for v in variables]
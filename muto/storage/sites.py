@@ -0,0 +1,441 @@
+'''
+A registry of observing sites, and a spatial and temporal index over the
+archives which hold their data.
+
+Every site records its position, elevation and instrument type, and where
+its data are kept: a group of a muto HDF5 file, or of a partitioned archive
+directory. Sites are bucketed into a grid of latitude/longitude cells, so a
+query for a bounding box only looks at the sites in the cells it covers, and
+only the archives of those sites are checked against the time window (from
+their extent attributes or manifest, without reading any data):
+
+    >>> reg = registry('network.json')
+    >>> reg.add('KCHO', 38.14, -78.45, 195., 'cl31', 'kcho.h5')
+    >>> reg.find(lat=(36, 40), lon=(-80, -76), timetup=(begin, end))
+    ['KCHO']
+
+The registry is a small JSON file, replaced in a single rename when saved.
+
+multi_slice reads the same window from many archives or groups at once, in a
+pool of worker processes, and can put the results on a common time grid.
+'''
+import os
+import json
+import math
+import tables
+import itertools
+import multiprocessing
+import numpy as np
+import logging as l
+from muto.storage.h5 import h5
+from muto.storage.partition import partitioned
+
+# default grid cell size, in degrees of latitude and longitude
+CELL = 1.
+
+
+class registry(object):
+    '''
+    Class for keeping and querying the sites of an observing network
+    '''
+
+    def __init__(self, fname, cell=CELL):
+        """
+        Open (or prepare) a site registry.
+
+        Parameters
+        ----------
+        fname : str
+            the JSON file of the registry. Relative archive paths of the sites
+            are taken from the directory of this file.
+        cell : float, optional
+            the size of the grid cells in degrees. An existing registry keeps
+            the cell size it was saved with.
+        """
+        self.filename = fname
+        self.directory = os.path.dirname(os.path.abspath(fname))
+        if os.path.exists(fname):
+            doc = json.load(open(fname))
+        else:
+            doc = {'cell':cell, 'sites':{}}
+        self.cell = float(doc['cell'])
+        self.sites = doc['sites']
+        self._build_grid()
+
+    def add(self, site, lat, lon, elevation=0., instrument='', source=None,
+            group='/', save=True, **metadata):
+        """
+        Add a site to the registry, replacing any site with the same id.
+
+        Parameters
+        ----------
+        site: str
+            the id of the site
+        lat, lon: float
+            the position of the site in degrees, longitude from -180 to 180
+        elevation: float, opt
+            the elevation of the site in meters
+        instrument: str, opt
+            the instrument type, such as 'cl31' or 'ct12'
+        source: str, opt
+            the HDF5 file or partitioned archive directory holding its data
+        group: str, opt
+            the group of its dataset within the source
+        save: bool, opt
+            write the registry file now
+        **metadata:
+            anything else to keep about the site
+        """
+        if not -90 <= lat <= 90 or not -180 <= lon <= 180:
+            raise ValueError('invalid site position: ' + str((lat, lon)))
+        if site in self.sites:
+            self.remove(site, save=False)
+        entry = dict(metadata)
+        entry.update({'lat':float(lat), 'lon':float(lon),
+                      'elevation':float(elevation), 'instrument':instrument,
+                      'source':source, 'group':group})
+        self.sites[site] = entry
+        self.grid.setdefault(self._cell(lat, lon), []).append(site)
+        if save:
+            self.save()
+
+    def remove(self, site, save=True):
+        '''
+        Remove a site from the registry (its data are left alone)
+        '''
+        entry = self.sites.pop(site)
+        key = self._cell(entry['lat'], entry['lon'])
+        self.grid[key].remove(site)
+        if not self.grid[key]:
+            del self.grid[key]
+        if save:
+            self.save()
+
+    def get(self, site):
+        '''
+        The entry of a site, a dict of its position, instrument and source
+        '''
+        return self.sites[site]
+
+    def within(self, lat=None, lon=None, instrument=None):
+        """
+        The ids of the sites within a bounding box, from the grid.
+
+        Parameters
+        ----------
+        lat: tuple, opt
+            (south, north) latitudes, every latitude if not given
+        lon: tuple, opt
+            (west, east) longitudes, every longitude if not given. A box
+            crossing the antimeridian has west > east.
+        instrument: str or list, opt
+            only sites with this instrument type (or one of these)
+
+        Returns
+        -------
+        out: list
+            the sorted site ids
+        """
+        if isinstance(instrument, basestring):
+            instrument = [instrument]
+        if lat is not None:
+            rows = (self._index(lat[0]), self._index(lat[1]))
+        if lon is not None:
+            cols = (self._index(lon[0]), self._index(lon[1]))
+        out = []
+        for (i, j), sites in self.grid.items():
+            # skip whole cells outside of the box
+            if lat is not None and not rows[0] <= i <= rows[1]:
+                continue
+            if lon is not None and not _between(j, cols[0], cols[1]):
+                continue
+            for site in sites:
+                entry = self.sites[site]
+                if lat is not None and not lat[0] <= entry['lat'] <= lat[1]:
+                    continue
+                if lon is not None and not _between(entry['lon'], lon[0],
+                                                    lon[1]):
+                    continue
+                if instrument and entry['instrument'] not in instrument:
+                    continue
+                out.append(site)
+        return sorted(out)
+
+    def find(self, lat=None, lon=None, begin=None, end=None, timetup=False,
+             instrument=None):
+        """
+        The ids of the sites within a bounding box which have data within a
+        time window. Only the archives of the sites in the box are opened,
+        and only their extent is read.
+
+        Parameters
+        ----------
+        lat, lon, instrument: opt
+            the bounding box and instrument types, see within()
+        begin, end: int, opt
+            epoch times of the window, either may be None
+        timetup: tuple, opt
+            (begin, end) of the window
+
+        Returns
+        -------
+        out: list
+            the sorted site ids
+        """
+        if timetup:
+            begin, end = timetup
+        return [site for site in self.within(lat, lon, instrument)
+                if self._has_data(site, begin, end)]
+
+    def slice(self, variables, lat=None, lon=None, begin=None, end=None,
+              timetup=False, instrument=None, workers=1, step=None,
+              tolerance=None):
+        """
+        Slice the data of every site within a bounding box and time window.
+
+        Parameters
+        ----------
+        variables: list
+            the variables to read, see h5.slice
+        begin, end, timetup:
+            the time window, which must have both a begin and end
+        lat, lon, instrument: opt
+            the sites to read, see within()
+        workers, step, tolerance: opt
+            read the sites in parallel, and align them on a time grid, see
+            multi_slice
+
+        Returns
+        -------
+        out: dict
+            site id: the slice of its data, for every site with data in the
+            window
+        """
+        if timetup:
+            begin, end = timetup
+        if begin is None or end is None:
+            raise ValueError('slice needs both the begin and end of a window')
+        sources = dict([(site, (self.source(site), self.sites[site]['group']))
+                        for site in self.find(lat, lon, begin, end,
+                                              instrument=instrument)])
+        return multi_slice(sources, variables, (begin, end), workers=workers,
+                           step=step, tolerance=tolerance)
+
+    def archive(self, site):
+        '''
+        The h5 or partitioned object of the archive of a site
+        '''
+        source = self.source(site)
+        if os.path.isdir(source):
+            return partitioned(source)
+        return h5(source)
+
+    def source(self, site):
+        '''
+        The path of the archive of a site
+        '''
+        source = self.sites[site]['source']
+        if source is None:
+            raise ValueError('no archive is registered for ' + site)
+        return os.path.join(self.directory, source)
+
+    def save(self):
+        '''
+        Write the registry, replacing the old one in a single rename so that
+        readers never see a partial file
+        '''
+        tmp = self.filename + '.tmp'
+        with open(tmp, 'w') as f:
+            json.dump({'cell':self.cell, 'sites':self.sites}, f, indent=1,
+                      sort_keys=True)
+        os.rename(tmp, self.filename)
+
+    def __len__(self):
+        return len(self.sites)
+
+    def __contains__(self, site):
+        return site in self.sites
+
+    def _index(self, degrees):
+        return int(math.floor(degrees / self.cell))
+
+    def _cell(self, lat, lon):
+        return (self._index(lat), self._index(lon))
+
+    def _build_grid(self):
+        '''
+        Bucket every site into its grid cell
+        '''
+        self.grid = {}
+        for site, entry in self.sites.items():
+            self.grid.setdefault(self._cell(entry['lat'], entry['lon']),
+                                 []).append(site)
+
+    def _has_data(self, site, begin, end):
+        '''
+        Does the archive of a site hold any data between begin and end
+        '''
+        entry = self.sites[site]
+        if entry['source'] is None:
+            return False
+        source = self.source(site)
+        if not os.path.exists(source):
+            l.warning('the archive of ' + site + ' is missing: ' + source)
+            return False
+        if os.path.isdir(source):
+            return bool(partitioned(source).partitions(begin, end,
+                                                       entry['group']))
+        try:
+            ext = h5(source).extent(entry['group'])
+        except tables.NoSuchNodeError:
+            return False
+        if not ext['row_count']:
+            return False
+        if begin is not None and ext['max_time'] < begin:
+            return False
+        if end is not None and ext['min_time'] > end:
+            return False
+        return True
+
+
+def _between(value, low, high):
+    '''
+    Is value from low to high, where low > high wraps around the antimeridian
+    '''
+    if low <= high:
+        return low <= value <= high
+    return value >= low or value <= high
+
+
+def multi_slice(sources, variables, timetup, workers=None, step=None,
+                tolerance=None, fname=None, shared=False, pool=None, **kwargs):
+    """
+    Slice the same time window from many archives, or groups of one archive,
+    reading them concurrently in a pool of worker processes.
+
+    Parameters
+    ----------
+    sources: list or dict
+        what to read: HDF5 files (or partitioned archive directories),
+        (file, group) pairs, or groups of fname. Results are keyed by these,
+        or given a dict of key: any of these, by its keys (site ids, say).
+    variables: list
+        the variables to read, see h5.slice
+    timetup: tuple
+        (begin, end) epoch times of the window
+    workers: int, opt
+        the number of reading processes, defaults to the number of cpus.
+        With 1 worker the sources are read in this process.
+    step: int, opt
+        align the results on a grid of times every step seconds, see align()
+    tolerance: float, opt
+        the furthest a row may be from a grid time, see align()
+    fname: str, opt
+        the file holding the sources given as groups
+    shared: bool, opt
+        open the files in the shared concurrency mode of h5
+    pool: multiprocessing.Pool, opt
+        an existing pool to read with, instead of starting one. Its workers
+        keep their read handles open between calls, which suits reading a
+        frame after frame.
+    **kwargs:
+        passed on to h5.slice (resolution, max_points, ...), for the
+        sources which are h5 files
+
+    Returns
+    -------
+    out: dict
+        key: the slice of that source
+    """
+    if isinstance(sources, dict):
+        keys = list(sources)
+        targets = [sources[k] for k in keys]
+    else:
+        keys = targets = list(sources)
+    jobs = []
+    for target in targets:
+        if isinstance(target, basestring):
+            target = (fname, target) if fname else (target, '/')
+        jobs.append((target[0], target[1], variables, tuple(timetup), shared,
+                     kwargs))
+    own = None
+    if pool is not None:
+        results = pool.map(_slice_source, jobs)
+    elif workers == 1 or len(jobs) < 2:
+        results = list(itertools.imap(_slice_source, jobs))
+    else:
+        own = multiprocessing.Pool(min(workers or multiprocessing.cpu_count(),
+                                       len(jobs)))
+        try:
+            results = own.map(_slice_source, jobs)
+        finally:
+            own.terminate()
+            own.join()
+    out = dict(zip(keys, results))
+    if step:
+        out = align(out, timetup, step, tolerance)
+    return out
+
+
+def align(results, timetup, step, tolerance=None):
+    """
+    Put slices on a common grid of times, from the begin to the end of the
+    window every step seconds.
+
+    Every grid time takes the row nearest to it, if that is within the
+    tolerance, and is otherwise missing: nan, or 0 for variables which are
+    not floats. The slices themselves (which may be read-only cached arrays)
+    are not modified.
+
+    Parameters
+    ----------
+    results: dict
+        key: slice, as returned by multi_slice
+    timetup: tuple
+        (begin, end) epoch times of the grid
+    step: int
+        the grid spacing in seconds
+    tolerance: float, opt
+        the furthest a row may be from a grid time, half a step by default
+
+    Returns
+    -------
+    out: dict
+        key: a structured array of the dtype of the slice, with one row for
+        every grid time
+    """
+    grid = np.arange(timetup[0], timetup[1] + 1, step)
+    if tolerance is None:
+        tolerance = step / 2.
+    out = {}
+    for key, rows in results.items():
+        aligned = np.zeros(grid.shape[0], dtype=rows.dtype)
+        for name in rows.dtype.names:
+            if aligned[name].dtype.kind == 'f':
+                aligned[name] = np.nan
+        if rows.shape[0]:
+            times = rows['time']
+            if (np.diff(times) < 0).any():
+                order = np.argsort(times, kind='mergesort')
+                rows, times = rows[order], times[order]
+            right = np.searchsorted(times, grid).clip(0, times.shape[0] - 1)
+            left = (right - 1).clip(0)
+            nearest = np.where(np.abs(times[left] - grid)
+                               <= np.abs(times[right] - grid), left, right)
+            found = np.abs(times[nearest] - grid) <= tolerance
+            aligned[found] = rows[nearest[found]]
+        aligned['time'] = grid
+        out[key] = aligned
+    return out
+
+
+def _slice_source(job):
+    '''
+    Worker process method, slicing a single archive
+    '''
+    source, group, variables, timetup, shared, kwargs = job
+    if os.path.isdir(source):
+        return partitioned(source, shared=shared).slice(
+            variables, timetup=timetup, group=group)
+    return h5(source, shared=shared).slice(variables, timetup=timetup,
+                                           group=group, **kwargs)
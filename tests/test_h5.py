@@ -0,0 +1,339 @@
+'''
+Tests of the muto HDF5 archive
+'''
+import os
+import sys
+import shutil
+import subprocess
+import tempfile
+import unittest
+import numpy as np
+from muto.accessories import instrument
+from muto.storage import h5 as h5module
+from muto.storage.h5 import h5, read_pool
+
+
+class ArchiveTest(unittest.TestCase):
+    '''
+    Base of the tests, giving each one a new file in a temporary directory
+    '''
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.fname = os.path.join(self.directory, 'test.h5')
+
+    def tearDown(self):
+        read_pool.clear()
+        shutil.rmtree(self.directory)
+
+    def rows(self, n, start=1000, step=10, seed=0):
+        '''
+        n times and (n x 3) values
+        '''
+        rs = np.random.RandomState(seed)
+        return (start + step * np.arange(n),
+                rs.rand(n, 3).astype(np.float32))
+
+
+class AppendManyTest(ArchiveTest):
+
+    def test_round_trip(self):
+        times, x = self.rows(50)
+        archive = h5(self.fname)
+        archive.create(x=[3], y=[])
+        self.assertEqual(archive.append_many(times, x=x, y=x[:, 0]), 50)
+        out = h5(self.fname).slice(['x', 'y'], timetup=(times[5], times[20]))
+        np.testing.assert_array_equal(out['time'], times[5:21])
+        np.testing.assert_array_equal(out['x'], x[5:21])
+        np.testing.assert_array_equal(out['y'], x[5:21, 0])
+        ext = h5(self.fname).extent()
+        self.assertEqual((ext['min_time'], ext['max_time'], ext['row_count']),
+                         (times[0], times[-1], 50))
+
+    def test_matches_append(self):
+        times, x = self.rows(10)
+        h5(self.fname).create(x=[3])
+        other = os.path.join(self.directory, 'other.h5')
+        h5(other).create(x=[3])
+        h5(self.fname).append_many(times, x=x)
+        for t, row in zip(times, x):
+            h5(other).append(t, x=row)
+        np.testing.assert_array_equal(
+            h5(self.fname).slice(['x'], timetup=(0, 2000)),
+            h5(other).slice(['x'], timetup=(0, 2000)))
+
+    def test_structured_array(self):
+        times, x = self.rows(10)
+        rows = np.empty(10, dtype=[('time', int), ('x', 'f4', (3,))])
+        rows['time'], rows['x'] = times, x
+        h5(self.fname).create(x=[3])
+        self.assertEqual(h5(self.fname).append_many(rows), 10)
+        np.testing.assert_array_equal(
+            h5(self.fname).slice(['x'], timetup=(0, 2000))['x'], x)
+
+    def test_filter(self):
+        times, x = self.rows(10)
+        archive = h5(self.fname)
+        archive.create(x=[3])
+        # a numpy bool decides for the whole batch
+        self.assertEqual(archive.append_many(
+            times, x=x, filter=lambda doc, t, data: np.all(t > 5000)), 0)
+        self.assertEqual(archive.append_many(
+            times, x=x, filter=lambda doc, t, data: t % 20 == 0), 5)
+        out = h5(self.fname).slice(['x'], timetup=(0, 2000))
+        np.testing.assert_array_equal(out['time'], times[::2])
+
+
+class SortBufferTest(ArchiveTest):
+
+    def test_out_of_order(self):
+        times, x = self.rows(100)
+        order = np.random.RandomState(1).permutation(100)
+        archive = h5(self.fname, sort_buffer=16)
+        archive.create(x=[3])
+        # in blocks, so rows are merged into those already written
+        for block in np.array_split(order, 7):
+            archive.append_many(times[block], persist=True, x=x[block])
+        archive.close()
+        out = h5(self.fname).slice(['x'], timetup=(0, 5000))
+        np.testing.assert_array_equal(out['time'], times)
+        np.testing.assert_array_equal(out['x'], x)
+        ext = h5(self.fname).extent()
+        self.assertTrue(ext['sorted'])
+        self.assertEqual(ext['row_count'], 100)
+
+    def test_single_appends(self):
+        times, x = self.rows(20)
+        archive = h5(self.fname, sort_buffer=5)
+        archive.create(x=[3])
+        for i in range(19, -1, -1):
+            archive.append(times[i], persist=True, x=x[i])
+        archive.flush()
+        out = h5(self.fname).slice(['x'], timetup=(0, 5000))
+        np.testing.assert_array_equal(out['time'], times)
+        np.testing.assert_array_equal(out['x'], x)
+
+    def test_repack(self):
+        times, x = self.rows(30)
+        archive = h5(self.fname)
+        archive.create(x=[3])
+        archive.append_many(times[::-1], x=x[::-1])
+        self.assertFalse(h5(self.fname).extent()['sorted'])
+        self.assertEqual(h5(self.fname).repack(), 30)
+        out = h5(self.fname).slice(['x'], timetup=(0, 5000))
+        np.testing.assert_array_equal(out['time'], times)
+        np.testing.assert_array_equal(out['x'], x)
+        self.assertTrue(h5(self.fname).extent()['sorted'])
+
+
+class DedupeTest(ArchiveTest):
+
+    def test_append_many(self):
+        times, x = self.rows(10)
+        archive = h5(self.fname, dedupe=True)
+        archive.create(x=[3])
+        self.assertEqual(archive.append_many(times[:6], persist=True,
+                                             x=x[:6]), 6)
+        # repeats of earlier rows, and within the batch
+        batch = np.r_[times[4:], times[8]]
+        self.assertEqual(archive.append_many(
+            batch, persist=True, x=np.r_[x[4:], x[:1]]), 4)
+        archive.close()
+        out = h5(self.fname).slice(['x'], timetup=(0, 5000))
+        np.testing.assert_array_equal(out['time'], times)
+        np.testing.assert_array_equal(out['x'], x)
+
+    def test_single_appends(self):
+        times, x = self.rows(10)
+        archive = h5(self.fname, dedupe=True)
+        archive.create(x=[3])
+        added = [archive.append(t, persist=True, x=row)
+                 for t, row in zip(np.r_[times, times[::3]],
+                                   np.r_[x, x[::3]])]
+        archive.close()
+        self.assertEqual(added, [True] * 10 + [False] * 4)
+        self.assertEqual(h5(self.fname).extent()['row_count'], 10)
+
+    def test_merged_times(self):
+        # appended times are merged into the sorted times past a threshold
+        buffer, h5module.DEDUPE_BUFFER = h5module.DEDUPE_BUFFER, 3
+        try:
+            self.test_single_appends()
+        finally:
+            h5module.DEDUPE_BUFFER = buffer
+
+    def test_other_writer(self):
+        # rows appended by another writer are seen through the row count
+        times, x = self.rows(10)
+        archive = h5(self.fname, dedupe=True)
+        archive.create(x=[3])
+        archive.append_many(times[:5], x=x[:5])
+        h5(self.fname).append_many(times[5:], x=x[5:])
+        self.assertEqual(archive.append_many(times, x=x), 0)
+
+
+class LevelsTest(ArchiveTest):
+
+    def check(self, times, x):
+        for seconds in (60, 600):
+            out = h5(self.fname).slice(['x'], timetup=(0, 10 ** 6),
+                                       resolution=seconds)
+            bins = np.unique(times - times % seconds)
+            np.testing.assert_array_equal(out['time'], bins)
+            for i, start in enumerate(bins):
+                rows = x[(times >= start) & (times < start + seconds)]
+                self.assertEqual(out['count'][i], rows.shape[0])
+                np.testing.assert_allclose(out['x'][i], rows.mean(axis=0),
+                                           rtol=1e-5)
+                np.testing.assert_array_equal(out['x_min'][i],
+                                              rows.min(axis=0))
+                np.testing.assert_array_equal(out['x_max'][i],
+                                              rows.max(axis=0))
+
+    def test_values(self):
+        times, x = self.rows(200, step=7)
+        archive = h5(self.fname)
+        archive.create(levels=[60, 600], x=[3])
+        # flushed in several parts, so bins are updated as they fill
+        for block in np.array_split(np.arange(200), 6):
+            archive.append_many(times[block], persist=True, x=x[block])
+            archive.flush(persist=True)
+        archive.close()
+        self.check(times, x)
+
+    def test_older_times(self):
+        times, x = self.rows(200, step=7)
+        archive = h5(self.fname)
+        archive.create(levels=[60, 600], x=[3])
+        archive.append_many(times[100:], x=x[100:])
+        archive.append_many(times[50:100:3], x=x[50:100:3])
+        archive.append_many(times[:50], x=x[:50])
+        keep = np.r_[np.arange(50), np.arange(50, 100, 3), np.arange(100, 200)]
+        self.check(times[keep], x[keep])
+
+    def test_max_points(self):
+        times, x = self.rows(200, step=7)
+        archive = h5(self.fname)
+        archive.create(levels=[60, 600], x=[3])
+        archive.append_many(times, x=x)
+        out = h5(self.fname).slice(['x'], timetup=(0, 10 ** 6),
+                                   max_points=50)
+        self.assertTrue('count' in out.dtype.names)
+        self.assertTrue(out.shape[0] <= 50)
+        out = h5(self.fname).slice(['x'], timetup=(0, 10 ** 6))
+        self.assertEqual(out.shape[0], 200)
+
+
+class SharedTest(ArchiveTest):
+    '''
+    The shared concurrency mode, with the other readers and writers in
+    separate processes
+    '''
+
+    def setUp(self):
+        ArchiveTest.setUp(self)
+        # newer HDF5 libraries lock files themselves, which would keep
+        # readers out of a file the writer has open
+        self.locking = os.environ.get('HDF5_USE_FILE_LOCKING')
+        os.environ['HDF5_USE_FILE_LOCKING'] = 'FALSE'
+
+    def tearDown(self):
+        if self.locking is None:
+            del os.environ['HDF5_USE_FILE_LOCKING']
+        else:
+            os.environ['HDF5_USE_FILE_LOCKING'] = self.locking
+        ArchiveTest.tearDown(self)
+
+    def run_python(self, code):
+        env = dict(os.environ)
+        env['PYTHONPATH'] = os.pathsep.join(sys.path)
+        return subprocess.check_output([sys.executable, '-c', code],
+                                       env=env).split()[-1]
+
+    def read_count(self):
+        return int(self.run_python(
+            'from muto.storage.h5 import h5\n'
+            + 'print h5(%r, shared=True).slice(["x"], timetup=(0, 10 ** 6))'
+            % self.fname + '.shape[0]'))
+
+    def can_lock(self, byte, shared=False):
+        return self.run_python(
+            'import os, fcntl\n'
+            + 'f = os.open(%r, os.O_RDWR)\n' % (self.fname + '.lock')
+            + 'try:\n'
+            + '    fcntl.lockf(f, fcntl.%s | fcntl.LOCK_NB, 1, %d)\n'
+            % ('LOCK_SH' if shared else 'LOCK_EX', byte)
+            + '    print True\n'
+            + 'except IOError:\n'
+            + '    print False') == 'True'
+
+    def test_flushed_rows(self):
+        times, x = self.rows(20)
+        writer = h5(self.fname, shared=True)
+        writer.create(close=False, x=[3])
+        writer.append_many(times[:10], persist=True, x=x[:10])
+        writer.flush(persist=True)
+        self.assertEqual(self.read_count(), 10)
+        # unflushed rows are not read, and do not keep readers out
+        writer.append_many(times[10:], persist=True, x=x[10:])
+        self.assertTrue(self.can_lock(0, shared=True))
+        self.assertEqual(self.read_count(), 10)
+        writer.flush(persist=True)
+        self.assertEqual(self.read_count(), 20)
+        writer.close()
+        self.assertEqual(self.read_count(), 20)
+
+    def test_writer_lock(self):
+        times, x = self.rows(10)
+        writer = h5(self.fname, shared=True)
+        writer.create(close=False, x=[3])
+        self.assertFalse(self.can_lock(1))
+        # handles of the data file come and go without dropping the lock
+        os.close(os.open(self.fname, os.O_RDONLY))
+        writer.append_many(times, persist=True, x=x)
+        writer.flush(persist=True)
+        self.assertFalse(self.can_lock(1))
+        writer.close()
+        self.assertTrue(self.can_lock(1))
+
+    def test_reader_lock(self):
+        h5(self.fname, shared=True).create(x=[3])
+        reader = h5(self.fname, shared=True)
+        reader.openr()
+        # a flush would wait for the reader
+        self.assertFalse(self.can_lock(0))
+        self.assertTrue(self.can_lock(0, shared=True))
+        reader.close()
+        self.assertTrue(self.can_lock(0))
+
+
+class RaggedTest(ArchiveTest):
+
+    def test_where_out_of_order(self):
+        archive = h5(self.fname, sort_buffer=10)
+        archive.create(ragged=True, height=[])
+        for t, height in [(10, 0), (30, 100), (20, 200), (40, 300)]:
+            archive.append_profiles([t], [1], persist=True, height=[height])
+        archive.close()
+        out = h5(self.fname).slice_ragged(['height'], timetup=(0, 100),
+                                          where=('height', 150, 250))
+        np.testing.assert_array_equal(out.time, [10, 20, 30, 40])
+        np.testing.assert_array_equal(out.count, [0, 1, 0, 0])
+        np.testing.assert_array_equal(out.points['height'], [200])
+
+    def test_instrumented_slice(self):
+        archive = h5(self.fname)
+        archive.create(ragged=True, height=[])
+        archive.append_profiles([10, 20], [2, 1], height=[1, 2, 3])
+        enabled = instrument.enabled
+        instrument.enable()
+        try:
+            out = h5(self.fname).slice(['height'], timetup=(0, 100))
+        finally:
+            instrument.enable(enabled)
+        self.assertEqual(len(out), 2)
+        np.testing.assert_array_equal(out.profile(0)['height'], [1, 2])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,66 @@
+'''
+Tests of reading ceilometer log files in batches
+'''
+import os
+import sys
+import shutil
+import tempfile
+import unittest
+import numpy as np
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(
+    os.path.abspath(__file__))), 'benchmarks'))
+import synthetic
+from muto.accessories.decoders.profile import logfile
+
+
+class IterLogTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.fname = os.path.join(self.directory, 'test.log')
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def read(self, instrument, **kwargs):
+        counts = {}
+        batches = list(logfile.iter_log(self.fname, instrument, counts=counts,
+                                        **kwargs))
+        return batches, counts
+
+    def test_batches(self):
+        for instrument in ('cl31', 'ct12'):
+            synthetic.log_file(self.fname, instrument, 25, code=2)
+            batches, counts = self.read(instrument, batch=10, chunk=1000)
+            self.assertEqual([len(t) for t, out in batches], [10, 10, 5])
+            self.assertEqual(counts['decoded'], 25)
+            times = np.concatenate([t for t, out in batches])
+            np.testing.assert_array_equal(np.diff(times), 16)
+
+    def test_noise_bytes(self):
+        # line noise between messages must not stop the file
+        synthetic.log_file(self.fname, 'cl31', 20, code=2)
+        data = open(self.fname, 'rb').read()
+        start = data.index('\x01', 5000)
+        open(self.fname, 'wb').write(data[:start] + '\xff\x80\x00'
+                                     + data[start:])
+        batches, counts = self.read('cl31')
+        self.assertEqual(counts['decoded'], 20)
+
+    def test_rejected_keeps_height(self):
+        # the height of 20 m messages has as many gates (500) as the batch
+        # has messages, and must not be masked with them
+        synthetic.log_file(self.fname, 'cl31', 500, code=2)
+        data = open(self.fname, 'rb').read()
+        start = data.index('\x01', 1000)
+        data = data[:start] + data[start:].replace('\x02', '\x02zz', 1)
+        open(self.fname, 'wb').write(data)
+        batches, counts = self.read('cl31', batch=500)
+        times, out = batches[0]
+        self.assertEqual(counts['rejected'], 1)
+        self.assertEqual(out['height'].shape[0], 500)
+        self.assertEqual(out['bs'].shape[0], 499)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,92 @@
+'''
+Tests of the time partitioned archive
+'''
+import os
+import json
+import shutil
+import tempfile
+import calendar
+import unittest
+import numpy as np
+from muto.storage.h5 import read_pool
+from muto.storage.partition import partitioned
+
+
+def epoch(*date):
+    return calendar.timegm(date + (0,) * (6 - len(date)))
+
+
+class PartitionedTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = os.path.join(tempfile.mkdtemp(), 'archive')
+        # one row every 6 hours from the middle of January to April 2013
+        self.times = np.arange(epoch(2013, 1, 20), epoch(2013, 4, 10), 21600)
+        self.x = np.random.RandomState(0).rand(self.times.shape[0], 2)
+
+    def tearDown(self):
+        read_pool.clear()
+        shutil.rmtree(os.path.dirname(self.directory))
+
+    def archive(self, **kwargs):
+        archive = partitioned(self.directory, **kwargs)
+        archive.create(x=[2])
+        archive.append_many(self.times, x=self.x)
+        return archive
+
+    def test_routing(self):
+        archive = self.archive()
+        self.assertEqual(sorted(os.listdir(self.directory)),
+                         ['2013-01.h5', '2013-02.h5', '2013-03.h5',
+                          '2013-04.h5', 'manifest.json'])
+        manifest = json.load(open(os.path.join(self.directory,
+                                               'manifest.json')))
+        ext = manifest['partitions']['2013-02']['/']
+        feb = (self.times >= epoch(2013, 2, 1)) & (self.times < epoch(2013, 3, 1))
+        self.assertEqual(ext['row_count'], feb.sum())
+        self.assertEqual(ext['min_time'], self.times[feb][0])
+        self.assertEqual(ext['max_time'], self.times[feb][-1])
+        self.assertEqual(archive.start(), self.times[0])
+        self.assertEqual(archive.end(), self.times[-1])
+
+    def test_days(self):
+        archive = self.archive(period='day')
+        self.assertEqual(len(archive.partitions()),
+                         np.unique(self.times // 86400).shape[0])
+        # an existing archive keeps its period
+        self.assertEqual(partitioned(self.directory, period='month').period,
+                         'day')
+
+    def test_slice(self):
+        archive = self.archive()
+        begin, end = epoch(2013, 1, 25), epoch(2013, 3, 5)
+        self.assertEqual(archive.partitions(begin, end),
+                         ['2013-01', '2013-02', '2013-03'])
+        out = partitioned(self.directory).slice(['x'], timetup=(begin, end))
+        keep = (self.times >= begin) & (self.times <= end)
+        np.testing.assert_array_equal(out['time'], self.times[keep])
+        np.testing.assert_allclose(out['x'], self.x[keep], rtol=1e-6)
+        # a window without data
+        out = archive.slice(['x'], timetup=(0, 1000))
+        self.assertEqual(out.shape, (0,))
+
+    def test_empty(self):
+        archive = partitioned(self.directory)
+        archive.create(x=[2])
+        self.assertEqual(archive.end(), 0)
+        self.assertEqual(archive.start(), 0)
+
+    def test_lost_manifest_entry(self):
+        # a partition whose dataset is missing from the manifest, as after a
+        # crash, is appended to rather than created again
+        self.archive()
+        archive = partitioned(self.directory)
+        del archive.manifest['partitions']['2013-02']
+        archive.append(epoch(2013, 2, 15, 1), x=[0, 0])
+        ext = archive.manifest['partitions']['2013-02']['/']
+        feb = (self.times >= epoch(2013, 2, 1)) & (self.times < epoch(2013, 3, 1))
+        self.assertEqual(ext['row_count'], feb.sum() + 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
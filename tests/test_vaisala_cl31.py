@@ -0,0 +1,78 @@
+'''
+Tests of the CL31 decoders, checking the array decoding against the one
+value at a time translation, and the batch reader against read()
+'''
+import os
+import sys
+import unittest
+import numpy as np
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(
+    os.path.abspath(__file__))), 'benchmarks'))
+import synthetic
+from muto.accessories.decoders.profile import vaisala_cl31
+
+
+class DecodeHexArrayTest(unittest.TestCase):
+
+    def scalar(self, string, char_count=5, bits=20):
+        return [vaisala_cl31.twos_comp(int(string[i:i + char_count], 16), bits)
+                for i in range(0, len(string), char_count)]
+
+    def test_matches_scalar(self):
+        rs = np.random.RandomState(0)
+        values = rs.randint(0, 2 ** 20, 500)
+        string = ''.join(['%05x' % v for v in values])
+        np.testing.assert_array_equal(
+            vaisala_cl31.decode_hex_array(string), self.scalar(string))
+        # upper case digits, and a trailing partial value
+        string = string.upper()[:-2]
+        np.testing.assert_array_equal(
+            vaisala_cl31.decode_hex_array(string), self.scalar(string))
+
+    def test_invalid_character(self):
+        self.assertRaises(ValueError, vaisala_cl31.decode_hex_array,
+                          '0000g00001')
+
+
+class ReadBatchTest(unittest.TestCase):
+
+    def check(self, obs):
+        out = vaisala_cl31.read_batch(obs)
+        self.assertTrue(out['valid'].all())
+        for i, ob in enumerate(obs):
+            single = vaisala_cl31.read(ob)
+            gates = single['bs'].shape[0]
+            np.testing.assert_allclose(out['bs'][i, :gates], single['bs'],
+                                       rtol=1e-6)
+            self.assertTrue(np.isnan(out['bs'][i, gates:]).all())
+            np.testing.assert_array_equal(out['status'][i], single['status'])
+        return out
+
+    def test_height_codes(self):
+        out = self.check(synthetic.messages('cl31', 12))
+        np.testing.assert_array_equal(out['resolution'],
+                                      [10, 20, 5, 5] * 3)
+        # mixed resolutions share no height
+        self.assertTrue(out['height'] is None)
+
+    def test_single_message(self):
+        out = self.check(synthetic.messages('cl31', 1, code=2))
+        np.testing.assert_array_equal(out['height'],
+                                      np.arange(0, 10000, 20))
+
+    def test_buffer(self):
+        obs = synthetic.messages('cl31', 4, code=1)
+        out = vaisala_cl31.read_batch(''.join(obs))
+        np.testing.assert_array_equal(out['bs'],
+                                      vaisala_cl31.read_batch(obs)['bs'])
+
+    def test_rejected_message(self):
+        obs = synthetic.messages('cl31', 3, code=1)
+        obs[1] = obs[1].replace('\x02\r\n', '\x02\r\nzz', 1)
+        out = vaisala_cl31.read_batch(obs)
+        np.testing.assert_array_equal(out['valid'], [True, False, True])
+        self.assertTrue(np.isnan(out['bs'][1]).all())
+
+
+if __name__ == '__main__':
+    unittest.main()
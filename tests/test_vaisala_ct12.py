@@ -0,0 +1,54 @@
+'''
+Tests of the CT12 decoders, checking the batch reader against read()
+'''
+import os
+import sys
+import unittest
+import numpy as np
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(
+    os.path.abspath(__file__))), 'benchmarks'))
+import synthetic
+from muto.accessories.decoders.profile import vaisala_ct12
+
+
+def texts(n, seed=0):
+    '''
+    n synthetic messages, without the STX/ETX characters
+    '''
+    return [ob[1:-1] for ob in synthetic.messages('ct12', n, seed=seed)]
+
+
+class ReadBatchTest(unittest.TestCase):
+
+    def check(self, obs, doFilter=True):
+        out = vaisala_ct12.read_batch(obs, doFilter)
+        self.assertTrue(out['valid'].all())
+        self.assertEqual(out['bs'].shape, (len(obs), 250))
+        for i, ob in enumerate(obs):
+            single = vaisala_ct12.read(ob, doFilter)
+            np.testing.assert_allclose(out['bs'][i], single['bs'], rtol=1e-6)
+            np.testing.assert_array_equal(out['status'][i], single['status'])
+        np.testing.assert_array_equal(out['height'], single['height'])
+
+    def test_matches_read(self):
+        self.check(texts(20))
+
+    def test_raw_values(self):
+        self.check(texts(5), doFilter=False)
+
+    def test_single_message(self):
+        # a batch of one complete message, as the last batch of a log may be
+        self.check(texts(1))
+
+    def test_rejected_message(self):
+        obs = texts(3)
+        obs[1] = obs[1].replace('0', 'g', 40)
+        out = vaisala_ct12.read_batch(obs)
+        np.testing.assert_array_equal(out['valid'], [True, False, True])
+        self.assertTrue(np.isnan(out['bs'][1]).all())
+        np.testing.assert_allclose(out['bs'][2],
+                                   vaisala_ct12.read(obs[2])['bs'], rtol=1e-6)
+
+
+if __name__ == '__main__':
+    unittest.main()